@@ -17,29 +17,119 @@
 # pyvassc requires su level privleges.
 # SEE man page for vas for additional information on the functionality of vas and the vastool
 import re
-import fileinput
 import os
 import sys
 import platform
-import shutil
 import subprocess
 import logging
 import time
+import tempfile
+import threading
+import Queue
+import multiprocessing
+import argparse
+import json
+import pipes
+import fcntl
+import difflib
+import collections
+import hashlib
+import signal
+import contextlib
+import functools
+import ctypes
+import ctypes.util
+import struct
+import select
 #
 # VARIABLE DEFINITION
 #
 file_to_test = 'nothing'# set the global variable to be edited later. This will be a path.
 line_to_test = 'auth\s*\[success=ok default=die\]\s*pam_localuser.so' # Regex for smartcard enforcement line
-dist_name = platform.linux_distribution()[0] # For Linux Distro's store the distribution name
-dist_version = platform.linux_distribution()[1] # For Linux Distro's store the version number
+dist_name = '' # For Linux Distro's store the distribution name, set from the host facts
+dist_version = '' # For Linux Distro's store the version number, set from the host facts
+host_facts = None # Distro, PAM services, display managers, PKCS#11 libs and vastool presence, gathered once by get_host_facts()
+facts_version = 1 # Bump when the facts layout changes so older cache files are ignored
+baseline_services = { # PAM services the script has always configured and enforced where they exist, for distros without a profile
+    'configure': ['login', 'common-auth', 'common-auth-pc', 'common-auth-smartcard', 'password-auth', 'password-auth-ac', 'smartcard-auth-ac', 'smartcard-auth', 'mdm', 'lightdm', 'lightdm-greeter', 'gdm', 'gdm-smartcard-ac', 'sddm'],
+    'enforce': ['password-auth', 'login', 'lightdm', 'mdm', 'lightdm-greeter', 'common-auth']}
+distro_profiles = [ # One profile per distro, the first whose match is in the distro name is used. backup, configure and enforce are PAM services: backed up before a run, configured for smartcards with vastool, and given the enforcement line
+    {'match': 'CentOS', 'manager': 'yum', 'packages': ['coolkey', 'opensc', 'esc', 'pam_pkcs11', 'pcsc-lite', 'ccid', 'opencryptoki', 'libc.so.6', 'libresolv.so.2', 'librt.so.1', 'libpam.so.0'],
+     'vassc': 'add-ons/smartcard/linux-x86_64/vassc-4.1.0-21853.x86_64.rpm', 'pkcs11_libs': ['/usr/lib64/opensc-pkcs11.so'],
+     'backup': ['gdm-password'], 'configure': ['login', 'password-auth', 'password-auth-ac', 'smartcard-auth-ac', 'smartcard-auth', 'gdm', 'gdm-smartcard-ac', 'lightdm', 'lightdm-greeter', 'mdm', 'sddm'], 'enforce': ['password-auth', 'login', 'lightdm', 'lightdm-greeter', 'mdm']},
+    {'match': 'Ubuntu', 'manager': 'apt-get', 'packages': ['libpcsclite1', 'pcscd', 'pcsc-tools', 'pkg-config', 'opensc', 'coolkey', 'libccid', 'libacsccid1'],
+     'vassc': 'add-ons/smartcard/linux-x86_64/vassc_4.1.0-21854_amd64.deb', 'pkcs11_libs': ['/usr/lib64/opensc-pkcs11.so'],
+     'backup': ['gdm-password'], 'configure': ['login', 'common-auth', 'lightdm', 'lightdm-greeter', 'mdm', 'gdm', 'sddm'], 'enforce': ['login', 'lightdm', 'lightdm-greeter', 'mdm', 'common-auth']},
+    {'match': 'SUSE', 'manager': 'zypper', 'packages': ['opensc', 'pam_pkcs11', 'pcsc-lite', 'pcsc-ccid', 'openCryptoki', 'libc.so.6', 'libresolv.so.2', 'librt.so.1', 'libpam.so.0'],
+     'vassc': 'add-ons/smartcard/linux-x86_64/vassc-4.1.0-21853.x86_64.rpm', 'pkcs11_libs': ['/usr/lib64/opensc-pkcs11.so'],
+     'backup': ['gdm-password'], 'configure': ['login', 'common-auth', 'common-auth-pc', 'common-auth-smartcard', 'password-auth', 'gdm', 'lightdm', 'lightdm-greeter', 'mdm', 'sddm'], 'enforce': ['password-auth', 'login', 'common-auth', 'lightdm', 'lightdm-greeter', 'mdm']},
+    {'match': 'Mint', 'manager': 'apt-get', 'packages': ['libpcsclite1', 'pcscd', 'pcsc-tools', 'pkg-config', 'opensc', 'coolkey', 'libccid', 'libacsccid1'],
+     'vassc': 'add-ons/smartcard/linux-x86_64/vassc_4.1.0-21854_amd64.deb', 'pkcs11_libs': ['/usr/lib/x86_64-linux-gnu/pkcs11/opensc-pkcs11.so', '/usr/lib64/opensc-pkcs11.so'],
+     'backup': [], 'configure': ['login', 'common-auth', 'mdm', 'lightdm', 'lightdm-greeter', 'gdm', 'sddm'], 'enforce': ['login', 'lightdm', 'mdm', 'lightdm-greeter', 'common-auth']},
+    {'match': 'Red', 'manager': 'yum', 'packages': ['coolkey', 'esc', 'pam_pkcs11', 'pcsc-lite', 'ccid', 'opencryptoki', 'libc.so.6', 'libresolv.so.2', 'librt.so.1', 'libpam.so.0'],
+     'vassc': 'add-ons/smartcard/linux-x86_64/vassc-4.1.0-21853.x86_64.rpm', 'pkcs11_libs': [],
+     'backup': ['gdm-password'], 'configure': ['login', 'password-auth', 'password-auth-ac', 'smartcard-auth-ac', 'smartcard-auth', 'gdm', 'gdm-smartcard-ac', 'lightdm', 'lightdm-greeter', 'mdm', 'sddm'], 'enforce': ['password-auth', 'login', 'lightdm', 'lightdm-greeter', 'mdm']},
+]
+fallback_profile = {'match': 'other', 'manager': None, 'packages': [], 'vassc': None, 'pkcs11_libs': [], # Distros without a profile: nothing is installed, only the baseline services are configured
+    'backup': ['gdm-password'], 'configure': baseline_services['configure'], 'enforce': baseline_services['enforce']}
+pkcs11_lib_paths = sorted(set(lib_path for profile in distro_profiles for lib_path in profile['pkcs11_libs'])) # Where the OpenSC PKCS#11 library can be installed
+host_profile_cache = None # Profile of the host being configured, resolved once by host_profile()
+release_files = ['/etc/os-release', '/etc/lsb-release', '/etc/redhat-release', '/etc/SuSE-release'] # Files the distro name and version are read from
 smartcard_line = 'auth\s*requisite\s*pam_vas_smartcard\.so\s*echo_return' # regex line for detecting where to insert enforcement
 mdm_line = '\AIncludeAll=true.*' # variable to detect MDM's include all = true
 mdm_pam_line = '\Aauth\s*sufficient\s*pam_succeed_if.so\s*user\s*ingroup\s*nopasswdlogin' #REgex for MDM 
-script_path = os.path.abspath(os.path.dirname(sys.argv[0])) # Location script is ran from.
+enforce_line = 'auth    [success=ok default=die]    pam_localuser.so' # Enforcement line inserted after smartcard_line
+mdm_smartcard_lines = ['auth	sufficient	pam_vas_smartcard.so', 'auth	requisite	pam_vas_smartcard.so echo_return'] # Lines inserted after mdm_pam_line
+pam_rule_regex = re.compile(r'\A\s*(-?[\w@]+)\s+(\[[^\]]*\]|\S+)\s*(\S*)\s*(.*)') # PAM rule: type, control, module, args
+compiled_patterns = {} # Cache of compiled regex patterns, filled by compile_pattern()
+vastool_path = '/opt/quest/bin/vastool' # Location of the QAS vastool
+vastool_workers = 4 # Number of vastool operations allowed to run at the same time
+pending_vastool = [] # vastool and other privileged commands waiting for run_vastool_batch()
+command_results = [] # Exit status and timing of every external command that has been run
+command_timeout = 300 # Seconds an external command may run before it is stopped, set with --timeout
+package_timeout = 1800 # Seconds a package install or install.sh may run, they download packages. Set with --package-timeout
+kill_grace = 10 # Seconds a stopped command gets to exit after SIGTERM before it is killed
+running_commands = [] # Commands started by run_command() that have not finished, stopped by cancel_commands()
+commands_lock = threading.Lock()
+commands_cancelled = threading.Event() # Set by cancel_commands() so queued commands are not started any more
+privileged_session = False # Set once sudo credentials have been validated for this run
+fleet_workers = 10 # Number of hosts configured at the same time in fleet mode
+fleet_retries = 1 # Number of times a failed host is retried in fleet mode
+remote_python = 'python' # Python 2.7 interpreter used on fleet targets
+fleet_timeout = 3600 # Seconds a fleet target may take, packages and QAS may be installed there. Set with fleet --host-timeout
+image_workers = multiprocessing.cpu_count() # Number of image roots configured at the same time, one process each
+vas_conf_path = '/etc/opt/quest/vas/vas.conf' # vasd settings written by vastool configure vas
+pkcs11_lib_setting = ('vas_auth', 'pkcs11-lib') # vas.conf section and key written by vastool smartcard configure pkcs11 lib
+vasd_settings = [('username-attr-name', 'samAccountName'), ('allow-upn-login', 'True')] # samAccountName as the primary human-readable identifier, UPN login for smartcards
+mdm_defaults_path = '/usr/share/mdm/defaults.conf' # MDM defaults, IncludeAll is switched off here
+lightdm_conf_dir = '/etc/lightdm/lightdm.conf.d' # LightDM drop-in directory that receives 10-ubuntu.conf
+inotify_mask = 0x8 | 0x40 | 0x80 | 0x200 # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE, package managers replace files by rename
+inotify_overflow = 0x4000 # IN_Q_OVERFLOW, events were dropped
+inotify_cloexec = 0x80000 # IN_CLOEXEC
+watch_settle = 1.0 # Seconds without changes the watcher waits for, so a package update that rewrites several files is corrected once
+script_path = os.path.dirname(os.path.abspath(globals().get('__file__', sys.argv[0]))) # Location of the script, the current directory when it is run from stdin.
+backup_dir = script_path + '/pam_backups' # Backup store: objects/<sha256> holds file contents, manifests/<run>.json describes each run
 current_time = time.strftime("%H:%M:%S") # time variable
 current_date = time.strftime("%d-%m-%Y") # date variable
-log_file_path = 'QASscript_' + dist_name + dist_version + '_' + current_date + '_' + current_time + '.log' # Where the log is being saved
+log_file_path = None # Where the log is being saved, set by setup_log_file() once the distro is known
+facts_cache_path = script_path + '/.pyvassc_facts.json' # Host facts cache, invalidated by the mtimes of the files they were read from
+facts_cache_writable = True # False for the read-only commands, which use the facts cache but never write it
+read_only_commands = ['audit', 'plan', 'backups'] # Commands that change nothing on the host, not even the facts cache
+ledger_path = script_path + '/.pyvassc_ledger.json' # Fingerprint of the last successful run of each step, per root
+ledger_version = 1 # Bump when the ledger layout changes so older ledgers are ignored
+script_version = '2.0' # Bump when a step changes what it does, so every host runs it again instead of skipping it
+ledger_steps = ['installqas', 'package_install', 'configure_pam'] # Steps skipped when nothing they depend on changed since their last success
+forced_steps = [] # Steps that run even when the ledger says they are done, set with --force
+package_db_paths = ['/var/lib/dpkg/status', '/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite'] # Package databases, they change whenever a package is installed or removed
 debug_flag = False # variable to call when you need to debug
+assume_yes = False # Answer yes to every prompt, for unattended runs
+log_dir = '.' # Directory the QASscript log file is written to
+events_file = None # Open JSON lines file receiving every structured event, set with --events
+profile_enabled = False # Keep events in memory and log an aggregated profile at the end, set with --profile
+recorded_events = [] # Events kept for the profile
+events_lock = threading.Lock() # Events come from vastool and fleet worker threads too
+current_step = None # Name of the step that is running, attached to command and write events
+root_path = '/' # Filesystem the configuration is read from and written to, set with --root for image roots and test trees
 intro_text = """
 ##################################################################
 #Title:    Python QAS Install
@@ -86,21 +176,31 @@ script from there.
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# create file handler and set level to debug
-file_handler = logging.FileHandler(log_file_path)
-file_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-
-# create stream handler and set level to info then print that stream to console
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.INFO)
-formatterstream = logging.Formatter("%(levelname)s - %(message)s")
-stream_handler.setFormatter(formatterstream)
-
-# add Handlers to logger
-logger.addHandler(stream_handler)
-logger.addHandler(file_handler)
+logger.addHandler(logging.NullHandler()) # Nothing is printed until setup_logging() runs, so importing this module stays silent
+stream_handler = None # Console handler, added once however often main() runs
+file_handler = None # Log file handler of the current run
+
+def setup_logging(): # create stream handler and set level to info then print that stream to console
+    global stream_handler
+    if stream_handler is not None:
+        return
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.INFO)
+    formatterstream = logging.Formatter("%(levelname)s - %(message)s")
+    stream_handler.setFormatter(formatterstream)
+    logger.addHandler(stream_handler)
+
+def setup_log_file(): # create file handler and set level to debug, named after the distro once the host facts are known
+    global log_file_path, file_handler
+    if file_handler is not None: # Every run of main() logs to its own file only
+        logger.removeHandler(file_handler)
+        file_handler.close()
+    log_file_path = os.path.join(log_dir, 'QASscript_' + dist_name + dist_version + '_' + current_date + '_' + current_time + '.log')
+    file_handler = logging.FileHandler(log_file_path)
+    file_handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
 #
 # END OF LOGGING DEFINITION
 #
@@ -108,16 +208,271 @@ logger.addHandler(file_handler)
 #
 # FUNCTIONS DEFINITION
 #
-def check_exists(local_file_to_test, local_line_to_test): #Checks to see if auth    [success=ok default=die]    pam_localuser.so already exists in the file before making any changes.
-    line_matched_check = False
-    test_file = open(local_file_to_test, "r")
-    for line in test_file:
-        if line_matched_check is False :
-            if re.match(local_line_to_test, line):
-                logger.info(local_line_to_test + ' Line exists already in: ' + local_file_to_test)
-                line_matched_check = True
-                return True
+def emit_event(event, **fields): # Record a structured event as one JSON line, and keep it for the profile.
+    if events_file is None and not profile_enabled:
+        return()
+    fields.update({'event': event, 'time': time.time(), 'host': platform.node()})
+    if 'step' not in fields:
+        fields['step'] = current_step
+    with events_lock:
+        if events_file is not None:
+            events_file.write(json.dumps(fields, sort_keys=True) + '\n')
+            events_file.flush()
+        if profile_enabled:
+            recorded_events.append(fields)
+
+@contextlib.contextmanager
+def step(name, target=None): # Time a phase of the run and emit a step event with its outcome.
+    global current_step
+    parent = current_step
+    current_step = name
+    start = time.time()
+    status = 'ok'
+    try:
+        yield
+    except SystemExit as e:
+        status = 'exit ' + str(e.code)
+        raise
+    except BaseException as e:
+        status = 'error: ' + e.__class__.__name__
+        raise
+    finally:
+        current_step = parent
+        emit_event('step', step=name, target=target, duration=time.time() - start, status=status)
+
+def instrumented(function): # Decorator that runs a function as a step named after it. The first string argument is recorded as its target.
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        target = None
+        for arg in args:
+            if isinstance(arg, basestring):
+                target = arg
+                break
+        with step(function.__name__, target):
+            return function(*args, **kwargs)
+    return wrapper
+
+def profile_report(): # Aggregate the recorded events per step: calls, time, commands, command time and bytes written.
+    profile = collections.OrderedDict()
+    for event in recorded_events:
+        totals = profile.setdefault(event['step'] or 'main', {'calls': 0, 'duration': 0.0, 'commands': 0, 'command_duration': 0.0, 'failed_commands': 0, 'writes': 0, 'bytes': 0})
+        if event['event'] == 'step':
+            totals['calls'] += 1
+            totals['duration'] += event['duration']
+        elif event['event'] == 'command':
+            totals['commands'] += 1
+            totals['command_duration'] += event['duration']
+            totals['failed_commands'] += 1 if event['returncode'] != 0 else 0
+        elif event['event'] == 'write':
+            totals['writes'] += 1
+            totals['bytes'] += event['bytes']
+    return profile
+
+def log_profile(): # Log the aggregated profile and emit it as a profile event.
+    profile = profile_report()
+    for name, totals in profile.items():
+        logger.info('%-24s %3d calls %8.3fs  %3d commands %8.3fs  %3d writes %8d bytes' % (name, totals['calls'], totals['duration'], totals['commands'], totals['command_duration'], totals['writes'], totals['bytes']))
+    emit_event('profile', steps=profile)
+
+def compile_pattern(pattern): # Compile a regex once and reuse it for every file and line it is tested against.
+    if pattern not in compiled_patterns:
+        compiled_patterns[pattern] = re.compile(pattern)
+    return compiled_patterns[pattern]
+
+def read_text(local_file): # Return the contents of a file, or None if it does not exist.
+    if not os.path.exists(local_file):
+        return None
+    with open(local_file, "r") as text_handle:
+        return text_handle.read()
+
+def parse_pam_text(local_file, text): # Parse PAM file contents that have already been read into its raw lines and a list of parsed rules.
+    pam_file = {'path': local_file, 'lines': text.splitlines(True), 'rules': [], 'changed': False}
+    index_pam_rules(pam_file)
+    return pam_file
+
+def parse_pam_file(local_file): # Read a PAM file once and parse it.
+    with open(local_file, "r") as pam_handle:
+        return parse_pam_text(local_file, pam_handle.read())
 
+def index_pam_rules(pam_file): # Rebuild the rule list (type, control, module, args) from the raw lines.
+    rules = []
+    for index, line in enumerate(pam_file['lines']):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        rule_match = pam_rule_regex.match(line)
+        if rule_match:
+            rule_type, control, module, args = rule_match.groups()
+            rules.append({'index': index, 'type': rule_type, 'control': control, 'module': module, 'args': args.strip(), 'line': line})
+    pam_file['rules'] = rules
+
+def pam_find(pam_file, pattern): # Return the line indexes of every rule matching pattern.
+    regex = compile_pattern(pattern)
+    return [rule['index'] for rule in pam_file['rules'] if regex.match(rule['line'])]
+
+def pam_has(pam_file, pattern): # True if any rule in the parsed PAM file matches pattern.
+    regex = compile_pattern(pattern)
+    for rule in pam_file['rules']:
+        if regex.match(rule['line']):
+            return True
+    return False
+
+def pam_insert_after(pam_file, pattern, new_lines): # Insert new_lines after every rule matching pattern, returns the number of insertions.
+    matches = set(pam_find(pam_file, pattern))
+    if not matches:
+        return 0
+    lines = []
+    for index, line in enumerate(pam_file['lines']):
+        if index in matches and not line.endswith('\n'):
+            line = line + '\n'
+        lines.append(line)
+        if index in matches:
+            lines.extend([new_line + '\n' for new_line in new_lines])
+    pam_file['lines'] = lines
+    pam_file['changed'] = True
+    index_pam_rules(pam_file)
+    return len(matches)
+
+def stage_file(local_file, contents): # Write contents to a fsynced temp file beside local_file with its permissions and ownership. Returns the temp path.
+    file_dir = os.path.dirname(local_file) or '.'
+    temp_fd, temp_path = tempfile.mkstemp(dir=file_dir, prefix='.' + os.path.basename(local_file) + '.')
+    try:
+        with os.fdopen(temp_fd, "w") as temp_handle:
+            temp_handle.write(contents)
+            temp_handle.flush()
+            os.fsync(temp_handle.fileno())
+        if os.path.exists(local_file): # Keep the original permissions and ownership
+            file_stat = os.stat(local_file)
+            os.chmod(temp_path, file_stat.st_mode & 0o7777)
+            try:
+                os.chown(temp_path, file_stat.st_uid, file_stat.st_gid)
+            except OSError:
+                logger.debug('Could not preserve ownership of ' + local_file)
+        else:
+            os.chmod(temp_path, 0o644)
+        emit_event('write', target=local_file, bytes=len(contents))
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return temp_path
+
+def sync_dir(dir_path): # fsync a directory so the renames inside it are on disk.
+    dir_fd = os.open(dir_path or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def write_file_atomic(local_file, contents): # Write contents to a temp file beside local_file, fsync it and rename it into place.
+    os.rename(stage_file(local_file, contents), local_file)
+    sync_dir(os.path.dirname(local_file))
+
+def write_pam_file(pam_file): # Write a parsed PAM file back to disk once, only if it was changed.
+    if pam_file['changed']:
+        write_file_atomic(pam_file['path'], ''.join(pam_file['lines']))
+        pam_file['changed'] = False
+        return True
+    return False
+
+def check_exists(pam_file, local_line_to_test): #Checks to see if auth    [success=ok default=die]    pam_localuser.so already exists in the parsed PAM file before making any changes.
+    if pam_has(pam_file, local_line_to_test):
+        logger.info(local_line_to_test + ' Line exists already in: ' + pam_file['path'])
+        return True
+    return False
+
+def host_path(path): # Location of a host path inside the --root filesystem.
+    if root_path == '/':
+        return path
+    return os.path.join(root_path, path.lstrip('/'))
+
+def offline_root(): # True when working on a filesystem other than the running host's, where vastool and package managers cannot be used.
+    return root_path != '/'
+
+def facts_sources(): # Files and directories whose mtimes decide whether cached host facts are still valid.
+    return [host_path(source) for source in release_files + ['/etc/pam.d', vastool_path] + sorted(set(os.path.dirname(lib_path) for lib_path in pkcs11_lib_paths))]
+
+def source_mtimes(): # mtime of every facts source, None for the ones that do not exist.
+    mtimes = {}
+    for source in facts_sources():
+        try:
+            mtimes[source] = os.stat(source).st_mtime
+        except OSError:
+            mtimes[source] = None
+    return mtimes
+
+def root_distribution(): # (name, version) from the os-release file of the --root filesystem.
+    fields = {}
+    for line in (read_text(host_path('/etc/os-release')) or '').splitlines():
+        if '=' in line:
+            key, value = line.split('=', 1)
+            fields[key.strip()] = value.strip().strip('"')
+    return fields.get('NAME', ''), fields.get('VERSION_ID', '')
+
+def gather_host_facts(mtimes): # Probe the host once for everything the configuration steps need to know.
+    distribution = root_distribution() if offline_root() else platform.linux_distribution()
+    pam_services = sorted(os.listdir(host_path('/etc/pam.d'))) if mtimes[host_path('/etc/pam.d')] is not None else []
+    return {'version': facts_version, 'root': root_path, 'mtimes': mtimes, 'dist_name': distribution[0], 'dist_version': distribution[1], 'pam_services': pam_services,
+            'display_managers': [manager for manager in ('mdm', 'lightdm', 'gdm', 'sddm') if manager in pam_services],
+            'pkcs11_libs': [lib_path for lib_path in pkcs11_lib_paths if os.path.exists(host_path(lib_path))], 'vastool': mtimes[host_path(vastool_path)] is not None}
+
+def get_host_facts(): # Host facts for this run, from the on-disk cache when none of their sources changed since it was written.
+    global host_facts
+    if host_facts is not None:
+        return host_facts
+    mtimes = source_mtimes()
+    if offline_root(): # The cache describes the running host only
+        host_facts = gather_host_facts(mtimes)
+        return host_facts
+    cached = None
+    try:
+        with open(facts_cache_path, "r") as cache_file:
+            cached = json.load(cache_file)
+    except (IOError, ValueError):
+        pass
+    if cached and cached.get('version') == facts_version and cached.get('root') == root_path and cached.get('mtimes') == mtimes:
+        host_facts = cached
+        return host_facts
+    host_facts = gather_host_facts(mtimes)
+    if not facts_cache_writable:
+        return host_facts
+    try:
+        write_file_atomic(facts_cache_path, json.dumps(host_facts, indent=2, sort_keys=True))
+    except (IOError, OSError) as e:
+        logger.debug('Host facts could not be cached. Error: %s' % e)
+    return host_facts
+
+def set_root(path): # Work on another filesystem root from now on. Host facts and the profile are resolved again for it.
+    global root_path, host_facts, host_profile_cache
+    root_path = os.path.abspath(path)
+    host_facts = None
+    host_profile_cache = None
+
+def has_pam_service(service): # True if /etc/pam.d has this service, from the host facts.
+    return service in get_host_facts()['pam_services']
+
+def match_profile(name): # The distro profile for a distribution name, with every service a run may change in its backup list.
+    for profile in distro_profiles:
+        if profile['match'] in name:
+            break
+    else:
+        profile = fallback_profile
+    profile = dict(profile)
+    services = profile['configure'] + profile['enforce'] + profile['backup']
+    profile['backup'] = [service for n, service in enumerate(services) if service not in services[:n]]
+    return profile
+
+def host_profile(): # The distro profile every step of this run is driven from, resolved once from the host facts.
+    global host_profile_cache
+    if host_profile_cache is None:
+        host_profile_cache = match_profile(get_host_facts()['dist_name'])
+        logger.debug('Using the ' + host_profile_cache['match'] + ' profile')
+    return host_profile_cache
+
+def profile_services(key): # The PAM services of the host profile listed under key that exist on this host.
+    return [service for service in host_profile()[key] if has_pam_service(service)]
+
+@instrumented
 def check_os(): # Function to determine OS and whether or not to continue
     from sys import platform
     if platform == "linux" or platform == "linux2": # Linux...
@@ -131,297 +486,1234 @@ def check_os(): # Function to determine OS and whether or not to continue
     elif platform == "darwin": #OS X...
         logger.error("Your OS is MAC")
         logger.error("This script is for Linux Machines only...")
-        exit_script(0)
+        exit_script(1)
             # End OS X...
     elif platform == "win32": # Windows...
         logger.error("Your OS is Windows")
         logger.error("This script is for Linux Machines only...")
-        exit_script(0)
+        exit_script(1)
             # End Windows...
     else:
         logger.error("I cannot determine your Operating System type...") # tell user that the OS cannot be determined and quit
-        exit_script(0)
+        exit_script(1)
 
 def exit_script(exit_code): # Function to exit script, will build exception handling in the future
     logger.info("Exiting script.")
     sys.exit(exit_code)
 
-def manipulate_pam_files(local_file_to_test, local_line_to_test):
-    line_matched = False
-    file_exists = False
-    if os.path.exists(local_file_to_test):    #Testing to see if /etc/pam.d/test exists.
-        file_exists = True
-        test_file = open(local_file_to_test, "r")
-        for line in test_file:
-            if line_matched is False:
-                if re.match(smartcard_line, line):   # Testing to ensure file is setup for smartcard auth before enforcing it.
-                    line_matched = True
-                    if check_exists(local_file_to_test, local_line_to_test): #Testing to see if pam_localuser.so already exists.
-                        logger.debug(local_file_to_test + " is already configured! Not making any changes...") # If it does exist make no changes.
-                    else:
-                        for line in fileinput.input(local_file_to_test, inplace=1):
-                            print (line),
-                            if re.match(smartcard_line, line):
-                                print ('auth    [success=ok default=die]    pam_localuser.so') # Enforce via pam_local.so module
-                        logger.debug('Configuring' + local_file_to_test) # Configure Message. Inform user of which files are being configured
-    if file_exists is True:
-        if line_matched is False: # Debug to see if file is smartcard configured
-            logger.error(local_file_to_test + " check failed")
-            logger.error("This means the files exists but is not configured for smartcard use.")
-            logger.error("Please configure " + local_file_to_test + " for smartcards.")
-            logger.error("Then restart this script.")
-            exit_script(0)
+@instrumented
+def manipulate_pam_files(plan, local_file_to_test, local_line_to_test): # Plan the enforcement line for a smartcard configured PAM file.
+    if not has_pam_service(os.path.basename(local_file_to_test)):    #Testing to see if /etc/pam.d/test exists.
+        return()
+    entry = plan_file(plan, local_file_to_test)
+    if vastool_pending(plan, local_file_to_test): # vastool has to configure it first, the edit is planned again after it runs
+        if local_file_to_test not in plan['deferred']:
+            plan['deferred'].append(local_file_to_test)
+        return()
+    pam_file = parse_pam_text(local_file_to_test, entry['new'])
+    if not pam_has(pam_file, smartcard_line): # Testing to ensure file is setup for smartcard auth before enforcing it.
+        plan['errors'].append(local_file_to_test + " exists but is not configured for smartcard use.")
+        return()
+    if check_exists(pam_file, local_line_to_test): #Testing to see if pam_localuser.so already exists.
+        logger.debug(local_file_to_test + " is already configured! Not making any changes...") # If it does exist make no changes.
+    else:
+        pam_insert_after(pam_file, smartcard_line, [enforce_line]) # Enforce via pam_local.so module
+        entry['new'] = ''.join(pam_file['lines'])
+        logger.debug('Configuring' + local_file_to_test) # Configure Message. Inform user of which files are being configured
+
+def privileged_command(args): # Prefix a command with sudo unless the script is already running as root.
+    if os.geteuid() == 0:
+        return list(args)
+    return ['sudo', '-n'] + list(args)
+
+def start_privileged_session(): # Validate sudo credentials once so every queued command reuses the same session.
+    global privileged_session
+    if privileged_session or os.geteuid() == 0:
+        privileged_session = True
+        return True
+    if subprocess.call(['sudo', '-v']) == 0:
+        privileged_session = True
+        return True
+    logger.error('***sudo credentials could not be validated***')
+    return False
 
-def file_copy(src_path, dst_path, file):
-    #if the destination path doesn't exist, create it
-    file_dstpath = dst_path + "/" + file
-    file_srcpath = src_path + "/" + file
-    if not os.path.exists(dst_path):
-        os.mkdir(dst_path)
-        logger.debug('Directory made: ' + dst_path)
+def signal_command(running, signum): # Signal a command and, unless it shares the terminal, every process it started.
     try:
-        shutil.copy2(file_srcpath, file_dstpath)
-        logger.debug('File copied to: ' + file_dstpath)
-    except shutil.Error as e:
-        logger.error(file_dstpath + ' not copied. Error: %s' % e)
-    except OSError as e:
-        logger.exception(file_dstpath + ' not copied. Error: %s' % e)
-
-def check_displaymanagers (): # Check for display managers.
-    line_matched = False
-    os.system("sudo /opt/quest/bin/vastool smartcard configure pam login") # All OS's need this file configured
-    if os.path.exists('/etc/pam.d/common-auth'):
-        logger.debug('Configuring /etc/pam.d/common-auth')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam common-auth") # common-auth
-    if os.path.exists('/etc/pam.d/common-auth-pc'):
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam common-auth-pc")
-    if os.path.exists('/etc/pam.d/common-auth-smartcard'):
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam common-auth-smartcard")
-    if os.path.exists('/etc/pam.d/password-auth'):
-        logger.debug('Configuring /etc/pam.d/password-auth')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam password-auth") # password-auth
-    if os.path.exists('/etc/pam.d/password-auth-ac'):
-        logger.debug('Configuring /etc/pam.d/password-auth-ac in case password-auth is inaccessible...')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam password-auth-ac") # password-auth-ac
-    if os.path.exists('/etc/pam.d/smartcard-auth-ac'):
-        logger.debug('Configuring /etc/pam.d/smartcard-auth-ac in case smartcard-auth is inaccessible...')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam smartcard-auth-ac") # smartcard-auth-ac
-    if os.path.exists('/etc/pam.d/smartcard-auth-ac'):
-        logger.debug('Configuring /etc/pam.d/smartcard-auth')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam smartcard-auth") # smartcard-auth
-    if os.path.exists('/etc/pam.d/mdm'): # MDM
-        logger.debug('MDM was detected, configuring...')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam mdm")
-        test_file = open('/etc/pam.d/mdm', "r") # Testing MDM for the smartcard line, primarily because it fails often.
-        for line in test_file:
-            if re.match(smartcard_line, line):
-                line_matched = True
-        if line_matched is False:
-            for line in fileinput.input('/etc/pam.d/mdm', inplace=1):
-                print (line),
-                if re.match(mdm_pam_line, line):
-                    print ('auth	sufficient	pam_vas_smartcard.so')
-                    print ('auth	requisite	pam_vas_smartcard.so echo_return')
-        if os.path.exists('/usr/share/mdm/defaults.conf'):
-            os.system("sudo sed -i 's/IncludeAll=true/IncludeAll=false/g' '/usr/share/mdm/defaults.conf'")# change the MDM Defaults to not show all users on login screen.
-            if debug_flag is True:
-                logger.debug('MDM /usr/share/mdm/defaults.conf has been configured')
-            logger.info('You will need to restart the mdm service after this script in order to function properly.') # Let user know they need to restart mdm after running this.
+        if running['group']:
+            os.killpg(running['process'].pid, signum)
         else:
-            logger.error('***/usr/share/mdm/defaults.conf was not detected. MDM was not configured correctly.***')
-    if os.path.exists('/etc/pam.d/lightdm'): #LightDM
-        logger.debug('LightDM was detected, configuring...')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam lightdm")
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam lightdm-greeter")
-        if os.path.exists(script_path + '/10-ubuntu.conf'):
-            file_copy(script_path, '/etc/lightdm/lightdm.conf.d', '10-ubuntu.conf')
-        else:
-            logger.error('***Script was not ran from original location. LightDM has not been completely configured.***')
-    if os.path.exists('/etc/pam.d/gdm'): #GDM
+            running['process'].send_signal(signum)
+    except OSError:
+        pass
+
+def stop_command(running, reason): # Stop a running command with SIGTERM, and SIGKILL after kill_grace seconds. Called from timer threads.
+    with commands_lock:
+        if running['finished'] or running['stopped']:
+            return
+        running['stopped'] = reason
+        signal_command(running, signal.SIGTERM)
+        running['kill_timer'] = threading.Timer(kill_grace, kill_command, [running])
+        running['kill_timer'].start()
+
+def kill_command(running): # Kill a command that did not exit after SIGTERM. A cancelled run no longer waits for it, so this also reaps it.
+    with commands_lock:
+        if not running['finished']:
+            signal_command(running, signal.SIGKILL)
+            running['process'].poll()
+
+def cancel_commands(): # Stop every running command and keep queued ones from starting.
+    commands_cancelled.set()
+    with commands_lock:
+        running = list(running_commands)
+    for command in running:
+        stop_command(command, 'cancelled')
+
+def read_stream(stream, lines, name, level): # Capture the lines of a command's stdout or stderr and stream them to the log as they arrive.
+    for line in iter(stream.readline, ''):
+        lines.append(line)
+        logger.log(level, name + ': ' + line.rstrip('\n'))
+    stream.close()
+
+def run_command(args, capture=False, timeout=None, stdin_data=None, interactive=False, name=None): # Run a command without a shell, stopping it after timeout seconds (command_timeout by default), and record its exit status, output and duration. With capture the caller judges the exit status. interactive leaves the terminal to the command. name prefixes its output in the log.
+    start = time.time()
+    timeout = command_timeout if timeout is None else timeout
+    name = name or os.path.basename(args[2] if args[:2] == ['sudo', '-n'] else args[0])
+    level = logging.DEBUG if capture else logging.INFO
+    stdout_lines = []
+    stderr_lines = []
+    try:
+        if interactive: # The QAS installer may prompt, it keeps the terminal
+            process = subprocess.Popen(args)
+        else: # Its own process group, so a stopped command does not leave children behind
+            with open(os.devnull, "r") as devnull:
+                process = subprocess.Popen(args, stdin=subprocess.PIPE if stdin_data is not None else devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setpgrp)
+    except OSError as e:
+        logger.error(' '.join(args) + ' could not be started. Error: %s' % e)
+        process = None
+    running = {'process': process, 'group': not interactive, 'finished': False, 'stopped': None, 'kill_timer': None}
+    if process is not None:
+        readers = []
+        if not interactive:
+            for stream, lines in ((process.stdout, stdout_lines), (process.stderr, stderr_lines)):
+                reader = threading.Thread(target=read_stream, args=(stream, lines, name, level))
+                reader.daemon = True
+                reader.start()
+                readers.append(reader)
+        timer = threading.Timer(timeout, stop_command, [running, 'timed out after %ds' % timeout])
+        with commands_lock:
+            running_commands.append(running)
+        timer.start()
+        try:
+            if stdin_data is not None:
+                try:
+                    process.stdin.write(stdin_data)
+                    process.stdin.close()
+                except IOError: # The command exited without reading all of it
+                    pass
+            returncode = process.wait()
+        except BaseException: # Interrupted, the command must not outlive the run
+            stop_command(running, 'cancelled')
+            raise
+        finally:
+            with commands_lock:
+                running['finished'] = process.poll() is not None
+                running_commands.remove(running)
+            timer.cancel()
+            timer.join()
+            if running['finished'] and running['kill_timer'] is not None: # A cancelled command that has not exited yet still gets its SIGKILL
+                running['kill_timer'].cancel()
+                running['kill_timer'].join()
+        for reader in readers: # A stopped command may leave children holding its output open
+            reader.join(kill_grace)
+    else:
+        returncode = 127
+    output = ''.join(stdout_lines)
+    errors = ''.join(stderr_lines)
+    result = {'command': ' '.join(args), 'returncode': returncode, 'duration': time.time() - start, 'output': output, 'errors': errors, 'stopped': running['stopped']}
+    command_results.append(result)
+    emit_event('command', command=result['command'], returncode=returncode, duration=result['duration'], stopped=running['stopped'], stdout=output[-2000:], stderr=errors[-2000:])
+    if running['stopped']:
+        logger.error(result['command'] + ' ' + running['stopped'] + ' and was stopped')
+    elif returncode != 0 and not capture:
+        logger.error(result['command'] + ' failed with exit code ' + str(returncode))
+    elif debug_flag is True:
+        logger.debug(result['command'] + ' finished in %.2fs with exit code %d' % (result['duration'], returncode))
+    return result
+
+def queue_command(args, group, timeout=None): # Queue a privileged command for run_vastool_batch(). Commands in the same group run in order, groups run concurrently.
+    pending_vastool.append({'args': list(args), 'group': group, 'timeout': timeout})
+
+def queue_vastool(args, group): # Queue a vastool operation. Everything that writes vas.conf shares the vas.conf group, vastool rewrites the whole file.
+    queue_command([vastool_path] + list(args), group)
+
+def queue_vastool_pam(service): # Queue vastool smartcard configuration for a PAM service. Each service file is independent.
+    queue_vastool(['smartcard', 'configure', 'pam', service], 'pam:' + service)
+
+def run_vastool_batch(): # Run every queued vastool operation and privileged command in one privileged session and return their results.
+    if not pending_vastool:
+        return []
+    operations = list(pending_vastool)
+    del pending_vastool[:]
+    commands_cancelled.clear()
+    if not start_privileged_session():
+        exit_script(1)
+    groups = []
+    grouped = {}
+    for operation in operations: # Keep the queue order inside each group
+        if operation['group'] not in grouped:
+            grouped[operation['group']] = []
+            groups.append(grouped[operation['group']])
+        grouped[operation['group']].append(operation)
+    work = Queue.Queue()
+    for group in groups:
+        work.put(group)
+    results = []
+    results_lock = threading.Lock()
+    def worker():
+        while True:
+            try:
+                group = work.get_nowait()
+            except Queue.Empty:
+                return
+            for operation in group:
+                if commands_cancelled.is_set():
+                    return
+                result = run_command(privileged_command(operation['args']), timeout=operation['timeout'])
+                with results_lock:
+                    results.append(result)
+    threads = [threading.Thread(target=worker) for n in range(min(vastool_workers, len(groups)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive(): # join() with a timeout so signals still reach the main thread
+                thread.join(0.5)
+    except BaseException: # Interrupted or rolled back: stop the commands before the caller touches the files they write
+        cancel_commands()
+        for thread in threads:
+            thread.join()
+        raise
+    failed = [result for result in results if result['returncode'] != 0]
+    logger.debug('%d vastool operations finished, %d failed' % (len(results), len(failed)))
+    return results
+
+def pam_path(service): # Path of a PAM service file.
+    return host_path('/etc/pam.d/' + service)
+
+def vas_setting(text, section, key): # Return the value of key in [section] of vas.conf contents, or '' if it is not set.
+    current_section = None
+    for line in (text or '').splitlines():
+        stripped = line.strip()
+        if stripped.startswith('['):
+            current_section = stripped.strip('[]').strip()
+        elif current_section == section and '=' in stripped and not stripped.startswith('#'):
+            name, value = stripped.split('=', 1)
+            if name.strip() == key:
+                return value.strip()
+    return ''
+
+def plan_smartcard_service(plan, service): # Hand a PAM service to vastool if it is not configured for smartcards yet.
+    if not has_pam_service(service) or plan['vastool_done']:
+        return()
+    local_file = pam_path(service)
+    entry = plan_file(plan, local_file)
+    if not pam_has(parse_pam_text(local_file, entry['new']), smartcard_line):
+        logger.debug('Configuring ' + local_file)
+        plan_vastool(plan, ['smartcard', 'configure', 'pam', service], 'pam:' + service, local_file)
+
+def plan_mdm(plan): # Plan the MDM smartcard lines and switch off IncludeAll in the MDM defaults.
+    logger.debug('MDM was detected, configuring...')
+    if vastool_pending(plan, pam_path('mdm')):
+        if pam_path('mdm') not in plan['deferred']:
+            plan['deferred'].append(pam_path('mdm'))
+    else:
+        mdm_entry = plan_file(plan, pam_path('mdm'))
+        mdm_file = parse_pam_text(pam_path('mdm'), mdm_entry['new']) # Testing MDM for the smartcard line, primarily because it fails often.
+        if not pam_has(mdm_file, smartcard_line):
+            pam_insert_after(mdm_file, mdm_pam_line, mdm_smartcard_lines)
+            mdm_entry['new'] = ''.join(mdm_file['lines'])
+    defaults_entry = plan_file(plan, host_path(mdm_defaults_path))
+    if defaults_entry['old'] is not None:
+        defaults_entry['new'] = defaults_entry['new'].replace('IncludeAll=true', 'IncludeAll=false') # change the MDM Defaults to not show all users on login screen.
+        restart_note = 'You will need to restart the mdm service after this script in order to function properly.' # Let user know they need to restart mdm after running this.
+        if defaults_entry['new'] != defaults_entry['old'] and restart_note not in plan['notes']:
+            plan['notes'].append(restart_note)
+    else:
+        logger.error('***' + host_path(mdm_defaults_path) + ' was not detected. MDM was not configured correctly.***')
+
+def plan_lightdm(plan): # Plan the LightDM drop-in shipped next to this script.
+    logger.debug('LightDM was detected, configuring...')
+    dropin = read_text(script_path + '/10-ubuntu.conf')
+    if dropin is not None:
+        plan_file(plan, host_path(lightdm_conf_dir + '/10-ubuntu.conf'))['new'] = dropin
+    else:
+        logger.error('***Script was not ran from original location. LightDM has not been completely configured.***')
+
+@instrumented
+def check_displaymanagers (plan): # Check for display managers and plan their PAM and configuration changes.
+    for service in host_profile()['configure']: # Only services that are not already configured for smartcards are handed to vastool
+        plan_smartcard_service(plan, service)
+    if 'mdm' in get_host_facts()['display_managers']: # MDM
+        plan_mdm(plan)
+    if 'lightdm' in get_host_facts()['display_managers']: #LightDM
+        plan_lightdm(plan)
+    if 'gdm' in get_host_facts()['display_managers']: #GDM
         logger.debug('GDM was detected, configuring...')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam gdm")
-    if os.path.exists('/etc/pam.d/gdm-smartcard-ac'):
-        logger.debug('GDM was detected, configuring /etc/pam.d/gdm-smartcard...')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam gdm-smartcard-ac")
-    if os.path.exists('/etc/pam.d/sddm'): #SDDM - We don't currently have it configured but we would like to find a solution.
+    if 'sddm' in get_host_facts()['display_managers']: #SDDM - We don't currently have it configured but we would like to find a solution.
         logger.error('SDDM was detected, however, we have no current configuration for SDDM.')
         logger.error('Please use GDM or LightDM for your primary display manager.')
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pam sddm")
-        
-def vasd_config (): # Configure vasd with the vastool
-    os.system("sudo /opt/quest/bin/vastool configure vas vasd username-attr-name samAccountName") # Configure vasd to allow samAccountName as the primary human-readable identifier
-    logger.debug("username-attr-name samAccountName set")
-    os.system("sudo /opt/quest/bin/vastool configure vas vasd allow-upn-login True") # Configure vasd to allow UPN login for smartcards
-    logger.debug("allow-upn-login True set")
-
-def package_install (): # run package managers for each OS
-    if 'CentOS' in dist_name:
-        logger.info("CENTOS MATCHED!")
-        os.system("sudo yum install -y coolkey opensc esc pam_pkcs11 pcsc-lite ccid opencryptoki libc.so.6 libresolv.so.2 librt.so.1 libpam.so.0")
-        os.system("sudo rpm -i ./add-ons/smartcard/linux-x86_64/vassc-4.1.0-21853.x86_64.rpm") # VASSC rpm package install.
-        os.system("sudo systemctl restart pcscd")
-        logger.debug("pcscd restarted")
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pkcs11 lib /usr/lib64/opensc-pkcs11.so")
-        return()
-    elif 'Ubuntu' in dist_name:
-        logger.info("Ubuntu MATCHED!")
-        os.system("sudo apt-get install -y libpcsclite1 pcscd pcsc-tools pkg-config opensc coolkey libccid libacsccid1 ")
-        os.system("sudo dpkg -iE ./add-ons/smartcard/linux-x86_64/vassc_4.1.0-21854_amd64.deb") # VASSC deb package install, will not install if already installed.
-        os.system("sudo systemctl restart pcscd")
-        logger.debug("pcscd restarted")
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pkcs11 lib /usr/lib64/opensc-pkcs11.so")
-        return()
-    elif 'SUSE' in dist_name:
-        logger.info("SUSE MATCHED!")
-        os.system("sudo zypper install -y opensc pam_pkcs11 pcsc-lite pcsc-ccid openCryptoki libc.so.6 libresolv.so.2 librt.so.1 libpam.so.0") #Zypper dependencies package installs
-        os.system("sudo rpm -i ./add-ons/smartcard/linux-x86_64/vassc-4.1.0-21853.x86_64.rpm") # VASSC rpm package install.
-        os.system("sudo systemctl restart pcscd")
-        logger.debug("pcscd restarted")
-        os.system("sudo /opt/quest/bin/vastool smartcard configure pkcs11 lib /usr/lib64/opensc-pkcs11.so")
+
+@instrumented
+def vasd_config (plan): # Plan the vasd settings that vas.conf does not already have
+    vas_conf = plan_file(plan, host_path(vas_conf_path))['old']
+    for key, value in vasd_settings:
+        if vas_setting(vas_conf, 'vasd', key).lower() != value.lower():
+            if plan['vastool_done']: # Under --root vastool would change the running host's vas.conf, not this one
+                logger.warning(host_path(vas_conf_path) + ' does not set ' + key + ' = ' + value + ', configure it once the image runs')
+                continue
+            plan_vastool(plan, ['configure', 'vas', 'vasd', key, value], 'vas.conf', host_path(vas_conf_path))
+            logger.debug(key + ' ' + value + ' planned')
+
+@instrumented
+def pkcs11_config (plan): # Plan the PKCS#11 library when vas.conf does not name one that is installed, whether or not this run installed the packages
+    installed_libs = [lib_path for lib_path in host_profile()['pkcs11_libs'] if lib_path in get_host_facts()['pkcs11_libs']]
+    if not installed_libs:
         return()
-    elif 'Mint' in dist_name:
-        logger.info("Mint MATCHED!")
-        os.system("sudo apt-get install -y libpcsclite1 pcscd pcsc-tools pkg-config opensc coolkey libccid libacsccid1 ")
-        os.system("sudo dpkg -iE ./add-ons/smartcard/linux-x86_64/vassc_4.1.0-21854_amd64.deb") # VASSC deb package install, will not install if already installed.
-        os.system("sudo systemctl restart pcscd")
-        logger.debug("pcscd restarted")
-        if os.path.exists('/usr/lib/x86_64-linux-gnu/pkcs11/opensc-pkcs11.so'):
-            os.system("sudo /opt/quest/bin/vastool smartcard configure pkcs11 lib /usr/lib/x86_64-linux-gnu/pkcs11/opensc-pkcs11.so")
-        if os.path.exists('/usr/lib64/opensc-pkcs11.so'):
-            os.system("sudo /opt/quest/bin/vastool smartcard configure pkcs11 lib /usr/lib64/opensc-pkcs11.so")
+    vas_conf = plan_file(plan, host_path(vas_conf_path))['old']
+    if vas_setting(vas_conf, pkcs11_lib_setting[0], pkcs11_lib_setting[1]) not in installed_libs:
+        if plan['vastool_done']:
+            logger.warning(host_path(vas_conf_path) + ' does not name an installed PKCS#11 library, configure it once the image runs')
+            return()
+        plan_vastool(plan, ['smartcard', 'configure', 'pkcs11', 'lib', installed_libs[-1]], 'vas.conf', host_path(vas_conf_path)) # Each call replaces the library, the last one is what was left configured
+        logger.debug('PKCS#11 library ' + installed_libs[-1] + ' planned')
+
+def installed_packages(manager, names): # Query the local package database once and return which of names are installed.
+    installed = set()
+    if manager == 'apt-get':
+        result = run_command(['dpkg-query', '-W', '-f', '${Package} ${Status}\n'] + names, capture=True)
+        for line in result['output'].splitlines():
+            fields = line.split()
+            if len(fields) >= 4 and fields[-1] == 'installed' and fields[-3] == 'install':
+                installed.add(fields[0])
+    else: # yum and zypper distros use rpm. --whatprovides also answers for library names such as libc.so.6
+        result = run_command(['rpm', '-q', '--whatprovides'] + names, capture=True)
+        missing = set(line[len('no package provides '):].strip() for line in result['output'].splitlines() if line.startswith('no package provides '))
+        if result['returncode'] == 127:
+            missing = set(names)
+        installed = set(name for name in names if name not in missing)
+    return installed
+
+@instrumented
+def package_install (): # run package managers for each OS, only for what is missing. Returns False if the install failed.
+    profile = host_profile()
+    if profile['manager'] is None:
         return()
-    elif 'Red' in dist_name:
-        logger.info("Red MATCHED!")
-        os.system("sudo yum install -y coolkey esc pam_pkcs11 pcsc-lite ccid opencryptoki libc.so.6 libresolv.so.2 librt.so.1 libpam.so.0")
-        os.system("sudo rpm -i ./add-ons/smartcard/linux-x86_64/vassc-4.1.0-21853.x86_64.rpm") # VASSC rpm package install.
-        os.system("sudo systemctl restart pcscd")
-        logger.debug("pcscd restarted")
+    logger.info(profile['match'] + " MATCHED!")
+    manager = profile['manager']
+    installed = installed_packages(manager, profile['packages'] + ['vassc'])
+    missing = [package for package in profile['packages'] if package not in installed]
+    vassc_path = script_path + '/' + profile['vassc'] # VASSC package file, installed in the same transaction as its dependencies
+    vassc_missing = 'vassc' not in installed and not os.path.exists(vassc_path)
+    if vassc_missing: # One missing file would make the package manager reject the whole transaction, the dependencies are installed without it
+        logger.error('***' + vassc_path + ' was not found, VASSC cannot be installed. Run the script from the QAS media.***')
+    elif 'vassc' not in installed:
+        missing.append(vassc_path)
+    if not missing:
+        if vassc_missing:
+            return False
+        logger.info('Smartcard packages are already installed, nothing to install.')
         return()
-        
+    logger.info('Installing: ' + ' '.join(missing))
+    if not start_privileged_session():
+        exit_script(1)
+    result = run_command(privileged_command([manager, 'install', '-y'] + missing), timeout=package_timeout)
+    if result['returncode'] != 0:
+        logger.error('***Smartcard packages were not installed***')
+        return False
+    queue_command(['systemctl', 'restart', 'pcscd'], 'pcscd')
+    global host_facts
+    host_facts = None # The install may have added PKCS#11 libraries, pkcs11_config() plans them
+    if [result for result in run_vastool_batch() if result['returncode'] != 0]: # Part of this step, a failure is not recorded in the ledger
+        logger.error('***pcscd could not be restarted***')
+        return False
+    if vassc_missing: # Not recorded in the ledger, a run from the QAS media installs it
+        return False
+
+@instrumented
 def check_vastool (): # ensure VAS/QAS is installed before allowing script to run.
-    if os.path.exists('/opt/quest/bin/vastool'):
+    if get_host_facts()['vastool']:
         return()
     else:
         logger.critical("VAS/QAS has not been installed. Please reinstall QAS and run the script again.")
-        exit_script(0)
+        exit_script(1)
         
+def ask_yes_no (question): # Ask a yes/no question until it gets an answer. assume_yes answers yes, end of input answers no.
+    yes = set(['yes','y', 'ye', ''])
+    no = set(['no','n'])
+    if assume_yes:
+        return True
+    while True:
+        print(question)
+        try:
+            choice = raw_input().lower()
+        except EOFError:
+            return False
+        if choice in yes:
+            return True
+        elif choice in no:
+            return False
+        print("Please respond with 'yes' or 'no'")
+
 def ask_continue (): # Verify if user wants to configure QAS and has the option to enable debugging mode
     yes = set(['yes','y', 'ye', ''])
     no = set(['no','n'])
     debug = set(['debug','d'])
     global debug_flag
-    print("Would you like to configure QAS now?")
-    choice = raw_input().lower()
-    if choice in yes:
-        debug_flag is False
+    if assume_yes:
         return True
-    elif choice in debug: 
-        debug_flag = True
-        if debug_flag is True:
+    while True:
+        print("Would you like to configure QAS now?")
+        try:
+            choice = raw_input().lower()
+        except EOFError:
+            choice = 'no'
+        if choice in yes:
+            return True
+        elif choice in debug:
+            debug_flag = True
             logger.info("***DEBUGGING ENABLED***")
-    elif choice in no:
-        exit_script(0)
-    else:
-        logger.info("Please respond with 'yes' or 'no'")
-        ask_continue ()# Just ask if the user wishes to continue
+            return True
+        elif choice in no:
+            exit_script(0)
+        logger.info("Please respond with 'yes' or 'no'") # Just ask if the user wishes to continue
 
 def remove (): # This function is called only when debugging is enabled to ask if the user wants to unconfigure QAS files that are not unconfigured normally when removing QAS.
-    global debug_flag
     if debug_flag is True:
         logger.debug("Debug Flag was successful")
-        yes = set(['yes','y', 'ye', ''])
-        no = set(['no','n'])
-        logger.info("***Would you like to remove QAS? (yes/no)***")
-        choice = raw_input().lower()
-        if choice in yes:
-            unconfigure('/etc/pam.d/login')
-            unconfigure('/etc/pam.d/lightdm')
-            unconfigure('/etc/pam.d/lightdm-greeter')
-            unconfigure('/etc/pam.d/gdm-password')
-            unconfigure('/etc/pam.d/mdm')
-            unconfigure('/etc/pam.d/password-auth')
-            unconfigure('/etc/pam.d/common-auth')
-            if os.path.exists('./install.sh'):
-                os.system("sudo ./install.sh remove")
-                logger.info("***QAS has been removed and unconfigured***")
-                exit_script(0)
+        if ask_yes_no("***Would you like to remove QAS? (yes/no)***"):
+            exit_script(remove_qas())
+
+@instrumented
+def remove_qas (): # Unconfigure the PAM files and remove QAS with its install.sh. Returns the exit status.
+    unconfigure_host()
+    if os.path.exists(script_path + '/install.sh'):
+        if start_privileged_session() and run_command(privileged_command([script_path + '/install.sh', 'remove']), timeout=package_timeout, interactive=True)['returncode'] == 0:
+            logger.info("***QAS has been removed and unconfigured***")
+            return 0
+        logger.error("***QAS has been unconfigured but install.sh remove failed***")
+        return 1
+    logger.error("***QAS has been unconfigured but not removed***")
+    print(install_missing)
+    return 0
+
+def unconfigure (plan, file_input): # Plan the removal of exactly the lines this script inserts into a PAM file: the enforcement line after each smartcard line, and the MDM smartcard pair.
+    if not has_pam_service(os.path.basename(file_input)):
+        return()
+    entry = plan_file(plan, file_input)
+    smartcard_regex = compile_pattern(smartcard_line)
+    enforce_regex = compile_pattern(line_to_test)
+    mdm_regex = compile_pattern(mdm_pam_line)
+    lines = entry['new'].splitlines(True)
+    kept = []
+    removed = []
+    previous_rule = '' # Last rule line seen, kept or removed
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if enforce_regex.match(line) and smartcard_regex.match(previous_rule):
+            removed.append(line.rstrip('\n'))
+            index += 1
+            continue
+        pair = [pair_line.rstrip('\n') for pair_line in lines[index:index + len(mdm_smartcard_lines)]]
+        if os.path.basename(file_input) == 'mdm' and mdm_regex.match(previous_rule) and pair == mdm_smartcard_lines:
+            removed.extend(pair)
+            previous_rule = lines[index + len(mdm_smartcard_lines) - 1]
+            index += len(mdm_smartcard_lines)
+            continue
+        if line.strip() and not line.strip().startswith('#'):
+            previous_rule = line
+        kept.append(line)
+        index += 1
+    if removed:
+        entry['new'] = ''.join(kept)
+        plan['removed'][file_input] = removed
+        logger.debug('Unconfiguring ' + file_input)
+
+@instrumented
+def build_unconfigure_plan(): # Plan the reverse of a configuration run, reading and writing each file once.
+    plan = new_plan(vastool_done=True)
+    for service in profile_services('backup'): # Every service a configuration run may have changed
+        unconfigure(plan, pam_path(service))
+    if 'mdm' in get_host_facts()['display_managers']:
+        defaults_entry = plan_file(plan, host_path(mdm_defaults_path))
+        backed_up = backed_up_contents(host_path(mdm_defaults_path))
+        if defaults_entry['old'] is not None and re.search(r'(?m)^IncludeAll=false$', defaults_entry['old']):
+            if backed_up is None or not re.search(r'(?m)^IncludeAll=true$', backed_up): # An administrator may have switched it off before this script ran
+                logger.warning(host_path(mdm_defaults_path) + ' has IncludeAll=false but no backup shows this script changed it, it is left as it is.')
             else:
-                logger.error("***QAS has been unconfigured but not removed***")
-                print(install_missing)
-                exit_script(0)
-        elif choice in no:
-            return()
-        else:
-            print("Please respond with 'yes' or 'no'")
-            remove()
+                defaults_entry['new'] = re.sub(r'(?m)^IncludeAll=false$', 'IncludeAll=true', defaults_entry['new']) # Undo the IncludeAll change
+            if defaults_entry['new'] != defaults_entry['old']:
+                plan['removed'][host_path(mdm_defaults_path)] = ['IncludeAll=false']
+                plan['notes'].append('You will need to restart the mdm service after this script in order to function properly.')
+    dropin_entry = plan_file(plan, host_path(lightdm_conf_dir + '/10-ubuntu.conf'))
+    if dropin_entry['old'] is not None and dropin_entry['old'] == read_text(script_path + '/10-ubuntu.conf'): # Only the drop-in this script installed
+        dropin_entry['new'] = None
+        plan['removed'][host_path(lightdm_conf_dir + '/10-ubuntu.conf')] = dropin_entry['old'].splitlines()
+    return plan
 
-def unconfigure (file_input): # This function performs the unconfiguration of the pam modules.
-    if os.path.exists(file_input):
-        logger.debug in fileinput.input(file_input, inplace=True)
-        if not re.match(line_to_test, line):
-            sys.stdout.write (line)
+@instrumented
+def unconfigure_host (): # Remove the smartcard enforcement from every PAM service and display manager in one transaction. Returns what was removed, per file.
+    plan = build_unconfigure_plan()
+    if plan_is_empty(plan):
+        logger.info('No smartcard enforcement was found. Nothing to change.')
+        return {}
+    logger.debug('Planned changes:\n' + format_plan(plan))
+    check_plan_errors(plan) # Nothing is backed up or written when the plan cannot be applied
+    backup_pam(run_backup_targets(plan))
+    apply_plan(plan)
+    for local_file, removed in plan['removed'].items():
+        logger.info('Removed %d lines from %s' % (len(removed), local_file))
+    return plan['removed']
 
-def installqas ():
-    global debug_flag
+def ask_install (): # When debugging is enabled, ask whether QAS should be installed at all. Answering no skips the install and the run goes on.
     if debug_flag is True:
         logger.info("***Debugging is enabled***")
-        yes = set(['yes','y', 'ye', ''])
-        no = set(['no','n'])
-        print("***Would you like to install QAS with debugging enabled? (yes/no)***")
-        choice = raw_input().lower() # Ask for Debug install
-        if choice in yes:
-            if os.path.exists('./install.sh'):
-                os.system("sudo ./install.sh -a")
-            else:
-                logger.error("***QAS cannot be installed***") # if it cannot find the QAS install.sh file 
-                logger.info(install_missing)
-        elif choice in no:
-            return()
-        else:
-            print("Please respond with 'yes' or 'no'")
-            installqas()
+        if not ask_yes_no("***Would you like to install QAS with debugging enabled? (yes/no)***"): # Ask for Debug install
+            return False
+    return True
+
+@instrumented
+def installqas (): # Install QAS with its install.sh. Returns False if QAS was not installed.
+    if os.path.exists(script_path + '/install.sh'):
+        installed = start_privileged_session() and run_command(privileged_command([script_path + '/install.sh', '-a']), timeout=package_timeout, interactive=True)['returncode'] == 0
+        global host_facts
+        host_facts = None # vastool may have just been installed
+        return installed
     else:
-        if os.path.exists('./install.sh'):# install normally if no debugging flag
-            os.system("sudo ./install.sh -a")
+        logger.error("***QAS cannot be installed***") # if it cannot find the QAS install.sh file
+        logger.info(install_missing)
+        return False
+
+def file_hash(contents): # sha256 of file contents, the name of its object in the backup store.
+    return hashlib.sha256(contents).hexdigest()
+
+@instrumented
+def backup_pam (files_to_backup): # Back up files into the content addressed store and record them in one manifest for this run. Returns the run id.
+    objects_dir = backup_dir + '/objects'
+    manifests_dir = backup_dir + '/manifests'
+    for store_dir in (objects_dir, manifests_dir):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+    run_id = time.strftime("%Y%m%d-%H%M%S") + '-' + str(os.getpid())
+    suffix = 0
+    while os.path.exists(manifests_dir + '/' + run_id + '.json'): # Runs in the same second get their own manifest
+        suffix += 1
+        run_id = time.strftime("%Y%m%d-%H%M%S") + '-' + str(os.getpid()) + '-' + str(suffix)
+    manifest = {'run': run_id, 'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'files': []}
+    for file_to_backup in files_to_backup:
+        contents = read_text(file_to_backup)
+        if contents is None:
+            continue
+        file_stat = os.stat(file_to_backup)
+        digest = file_hash(contents)
+        object_path = objects_dir + '/' + digest
+        if not os.path.exists(object_path): # Unchanged files are already stored
+            write_file_atomic(object_path, contents)
+            logger.info(file_to_backup + ' was backed up to ' + object_path)
         else:
-            logger.error("***QAS cannot be installed***")# Ask for Debug install
-            logger.info(install_missing)
+            logger.debug(file_to_backup + ' is unchanged since it was last backed up')
+        manifest['files'].append({'path': file_to_backup, 'mode': file_stat.st_mode & 0o7777, 'uid': file_stat.st_uid, 'gid': file_stat.st_gid, 'hash': digest, 'mtime': file_stat.st_mtime})
+    write_file_atomic(manifests_dir + '/' + run_id + '.json', json.dumps(manifest, indent=2, sort_keys=True))
+    logger.info('Backup ' + run_id + ' recorded ' + str(len(manifest['files'])) + ' files')
+    return run_id
 
-def backup_pam (file_to_backup): # Function to backup PAM files.
-    global debug_flag
-    if debug_flag is True:
-        logger.debug('Backup pam for' + file_to_backup + ' waiting for path exist flag...')
-    if os.path.exists(file_to_backup):
-        if debug_flag is True:
-            logger.debug('path exists...')
-        movedir = script_path + "/pam_backups" # Original DIR
-        if debug_flag is True:
-            logger.debug('movedir variable created: ' + movedir)
-        filename = os.path.basename(file_to_backup)
-        if debug_flag is True:
-            logger.debug('filename variable created: ' + filename)
-        base, extension = os.path.splitext(filename)
-        if debug_flag is True:
-            logger.debug('base and extension variables created: ' + base + ' ' + extension)
-        backup_file = movedir + '/' + base + '_backup'
-        if debug_flag is True:
-            logger.debug('backup_file variable created: ' + backup_file)
-        if not os.path.exists(backup_file):
-            if not os.path.exists(movedir):
-                os.mkdir(movedir)
-            shutil.copy2(file_to_backup, backup_file)
-            logger.info(file_to_backup + ' was backed up to ' + backup_file)
+def list_backups (): # Every backup manifest, oldest first.
+    manifests_dir = backup_dir + '/manifests'
+    if not os.path.exists(manifests_dir):
+        return []
+    manifests = []
+    for name in os.listdir(manifests_dir):
+        if name.endswith('.json'):
+            with open(manifests_dir + '/' + name, "r") as manifest_file:
+                manifests.append(json.load(manifest_file))
+    return sorted(manifests, key=lambda manifest: (manifest['time'], manifest['run']))
+
+def backed_up_contents (local_file): # Contents of local_file in the newest backup run that saved it, None if none did.
+    for manifest in reversed(list_backups()):
+        for entry in manifest['files']:
+            if entry['path'] == local_file:
+                return read_text(backup_dir + '/objects/' + entry['hash'])
+    return None
+
+@instrumented
+def restore_backup (run_id): # Put every file recorded by a backup run back, with its mode and owner. 'latest' restores the newest run.
+    manifests = list_backups()
+    if run_id == 'latest' and manifests:
+        run_id = manifests[-1]['run']
+    matching = [manifest for manifest in manifests if manifest['run'] == run_id]
+    if not matching:
+        logger.error('***No backup named ' + run_id + ' was found in ' + backup_dir + '***')
+        return False
+    for entry in matching[0]['files']:
+        contents = read_text(backup_dir + '/objects/' + entry['hash'])
+        if contents is None or file_hash(contents) != entry['hash']:
+            logger.error('***Backup of ' + entry['path'] + ' is missing or damaged, it was not restored***')
+            return False
+    for entry in matching[0]['files']:
+        write_file_atomic(entry['path'], read_text(backup_dir + '/objects/' + entry['hash']))
+        os.chmod(entry['path'], entry['mode'])
+        try:
+            os.chown(entry['path'], entry['uid'], entry['gid'])
+        except OSError:
+            logger.debug('Could not restore ownership of ' + entry['path'])
+        logger.info(entry['path'] + ' was restored from backup ' + run_id)
+    return True
+
+def new_plan(vastool_done=False): # An empty change plan. Each file is read once and every step edits the same in-memory copy.
+    return {'vastool': [], 'files': collections.OrderedDict(), 'deferred': [], 'errors': [], 'notes': [], 'removed': collections.OrderedDict(), 'vastool_done': vastool_done}
+
+def plan_file(plan, local_file): # Return the plan entry for local_file, reading it from disk the first time it is needed.
+    if local_file not in plan['files']:
+        contents = read_text(local_file)
+        plan['files'][local_file] = {'old': contents, 'new': contents}
+    return plan['files'][local_file]
+
+def plan_vastool(plan, args, group, target): # Add a vastool operation that changes target to the plan. Never for a plan made after vastool ran or under --root.
+    if plan['vastool_done']:
+        raise ValueError('vastool ' + ' '.join(args) + ' planned for ' + target + ' where vastool cannot run')
+    plan['vastool'].append({'args': args, 'group': group, 'target': target})
+
+def vastool_pending(plan, local_file): # True if a planned vastool operation will change local_file.
+    for operation in plan['vastool']:
+        if operation['target'] == local_file:
+            return True
+    return False
+
+def plan_changes(plan): # The (path, entry) pairs of every file the plan rewrites.
+    return [(local_file, entry) for local_file, entry in plan['files'].items() if entry['new'] != entry['old']]
+
+def plan_targets(plan): # Every existing file the plan changes, directly or through vastool.
+    targets = [operation['target'] for operation in plan['vastool']] + [local_file for local_file, entry in plan_changes(plan)]
+    return [local_file for n, local_file in enumerate(targets) if local_file not in targets[:n] and os.path.exists(local_file)]
+
+def run_backup_targets(plan): # The files a run backs up: every file the plan changes and every existing PAM service in the host profile's backup list.
+    targets = plan_targets(plan)
+    return targets + [pam_path(service) for service in profile_services('backup') if pam_path(service) not in targets]
+
+def plan_is_empty(plan): # True when the host already matches the plan and nothing would be run or written.
+    return not plan['vastool'] and not plan['deferred'] and not plan['errors'] and not plan_changes(plan)
+
+@instrumented
+def build_plan(vastool_done=False): # Inspect the host once and plan every vasd, PAM and display manager change.
+    plan = new_plan(vastool_done or offline_root()) # vastool only configures the running host, under --root only the file edits are planned
+    if not vastool_done:
+        vasd_config(plan)
+        pkcs11_config(plan)
+    check_displaymanagers(plan)
+    for service in host_profile()['enforce']:
+        manipulate_pam_files(plan, pam_path(service), line_to_test)
+    return plan
+
+def format_plan(plan): # Render a plan as the vastool commands it runs and unified diffs of the files it writes.
+    output = []
+    for operation in plan['vastool']:
+        output.append(vastool_path + ' ' + ' '.join(operation['args']) + '\n')
+    for local_file in plan['deferred']:
+        output.append(local_file + ': enforcement is planned again once vastool has configured it\n')
+    for local_file, entry in plan_changes(plan):
+        old_lines = (entry['old'] or '').splitlines(True)
+        from_file = local_file if entry['old'] is not None else '/dev/null'
+        to_file = local_file if entry['new'] is not None else '/dev/null'
+        for line in difflib.unified_diff(old_lines, (entry['new'] or '').splitlines(True), from_file, to_file):
+            output.append(line if line.endswith('\n') else line + '\n')
+    for error in plan['errors']:
+        output.append('ERROR: ' + error + '\n')
+    return ''.join(output)
+
+class TransactionInterrupted(Exception): # Raised from a signal handler so an open transaction is rolled back, and when vastool fails inside one.
+    def __init__(self, message, signum=None):
+        Exception.__init__(self, message)
+        self.signum = signum # The signal that stopped the transaction, None when vastool failed
+
+def begin_transaction(local_files): # Snapshot the files a transaction may change so they can be put back exactly.
+    transaction = {'originals': collections.OrderedDict(), 'staged': collections.OrderedDict(), 'created_dirs': []}
+    for local_file in local_files:
+        snapshot_file(transaction, local_file)
+    return transaction
+
+def snapshot_file(transaction, local_file): # Remember the original contents, mode and owner of local_file, once.
+    if local_file in transaction['originals']:
+        return()
+    original = {'contents': read_text(local_file)}
+    if original['contents'] is not None:
+        file_stat = os.stat(local_file)
+        original.update({'mode': file_stat.st_mode & 0o7777, 'uid': file_stat.st_uid, 'gid': file_stat.st_gid})
+    transaction['originals'][local_file] = original
+
+def transaction_stage(transaction, local_file, contents): # Stage new contents for local_file in a fsynced temp file, None stages its removal. Nothing is replaced until commit.
+    snapshot_file(transaction, local_file)
+    if contents is None: # Staged deletion
+        transaction['staged'][local_file] = None
+        return()
+    file_dir = os.path.dirname(local_file)
+    if not os.path.exists(file_dir):
+        os.makedirs(file_dir)
+        transaction['created_dirs'].append(file_dir)
+        logger.debug('Directory made: ' + file_dir)
+    transaction['staged'][local_file] = stage_file(local_file, contents)
+
+def transaction_commit(transaction): # Rename every staged file into place.
+    for local_file, temp_path in transaction['staged'].items():
+        if temp_path is None:
+            os.remove(local_file)
+            logger.debug('Removed ' + local_file)
         else:
-            logger.info('Another backup was detected!')
-            backup_file = movedir + '/' + base + '_backup_' + current_date + '_' + current_time
-            if not os.path.exists(backup_file):
-                if not os.path.exists(movedir):
-                    os.mkdir(movedir)
-                shutil.copy2(file_to_backup, backup_file)
-                logger.info(file_to_backup + ' was backed up to ' + backup_file)
-            else:
-                logger.error('***Backups FAILED***')
-                exit_script(0)
+            os.rename(temp_path, local_file)
+            logger.debug('Configured ' + local_file)
+        del transaction['staged'][local_file]
+    for file_dir in set(os.path.dirname(local_file) for local_file in transaction['originals']):
+        if os.path.exists(file_dir):
+            sync_dir(file_dir)
+
+def transaction_rollback(transaction): # Drop staged files and put every snapshotted file back the way it was.
+    for temp_path in transaction['staged'].values():
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+    transaction['staged'].clear()
+    for local_file, original in transaction['originals'].items():
+        try:
+            if original['contents'] is None:
+                if os.path.exists(local_file):
+                    os.remove(local_file)
+            elif read_text(local_file) != original['contents'] or os.stat(local_file).st_mode & 0o7777 != original['mode']:
+                write_file_atomic(local_file, original['contents'])
+                os.chmod(local_file, original['mode'])
+                try:
+                    os.chown(local_file, original['uid'], original['gid'])
+                except OSError:
+                    logger.debug('Could not restore ownership of ' + local_file)
+                logger.info(local_file + ' was rolled back')
+        except (IOError, OSError) as e:
+            logger.critical('***' + local_file + ' could not be rolled back, restore it from ' + backup_dir + '. Error: %s***' % e)
+    for file_dir in reversed(transaction['created_dirs']):
+        if os.path.exists(file_dir) and not os.listdir(file_dir):
+            os.rmdir(file_dir)
+
+def interrupt_transaction(signum, frame): # Signal handler used while a transaction is open.
+    raise TransactionInterrupted('signal ' + str(signum), signum)
+
+def check_plan_errors(plan): # Stop before writing anything if a file the plan needs cannot be configured.
+    if plan['errors']:
+        for error in plan['errors']:
+            logger.error(error)
+        logger.error("Please configure these files for smartcards.")
+        logger.error("Then restart this script.")
+        exit_script(1)
+
+@instrumented
+def apply_plan(plan, replan=None): # Run the planned vastool operations and write every planned file change as one transaction. Any failure or signal rolls all of it back. replan plans again after vastool, build_plan by default.
+    check_plan_errors(plan)
+    transaction = begin_transaction([operation['target'] for operation in plan['vastool']] + [local_file for local_file, entry in plan_changes(plan)])
+    handled_signals = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]
+    previous_handlers = dict((signum, signal.signal(signum, interrupt_transaction)) for signum in handled_signals)
+    try:
+        if plan['vastool']:
+            for operation in plan['vastool']:
+                queue_vastool(operation['args'], operation['group'])
+            failed = [result for result in run_vastool_batch() if result['returncode'] != 0]
+            if failed:
+                raise TransactionInterrupted(str(len(failed)) + ' vastool operations failed')
+            plan = (replan or build_plan)(vastool_done=True) # Re-read what vastool changed and plan the edits that depend on it
+            check_plan_errors(plan)
+        for local_file, entry in plan_changes(plan):
+            transaction_stage(transaction, local_file, entry['new'])
+        transaction_commit(transaction)
+    except BaseException as e:
+        logger.error('***Configuration was interrupted (%s), rolling back every change***' % (e or e.__class__.__name__))
+        pending_signals = [] # A second signal must not stop the rollback halfway, it is acted on once every file is back
+        for signum in handled_signals:
+            signal.signal(signum, lambda signum, frame: pending_signals.append(signum))
+        transaction_rollback(transaction)
+        if isinstance(e, TransactionInterrupted) and e.signum is not None:
+            exit_script(128 + e.signum) # 128 + signal, like a shell, tells a signal apart from a failed change
+        if pending_signals:
+            exit_script(128 + pending_signals[0])
+        if isinstance(e, TransactionInterrupted):
+            exit_script(1)
+        raise
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    for note in plan['notes']:
+        logger.info(note)
+
+def path_stat(path): # (size, mtime) of a path or None, a cheap stand-in for the version of a binary or package database.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+def path_digest(path): # sha256 of a file or None if it does not exist.
+    contents = read_text(path)
+    return file_hash(contents) if contents is not None else None
+
+def step_fingerprint(step_name): # Hash of everything a ledger step depends on, taken from the host as it is now.
+    profile = host_profile()
+    inputs = {'script': script_version, 'root': root_path, 'step': step_name}
+    if step_name == 'installqas':
+        inputs['installer'] = path_stat(script_path + '/install.sh')
+        inputs['vastool'] = path_stat(host_path(vastool_path))
+    elif step_name == 'package_install':
+        inputs['profile'] = [profile['manager'], profile['packages'], profile['vassc'], profile['pkcs11_libs']]
+        inputs['vassc'] = path_stat(script_path + '/' + profile['vassc']) if profile['vassc'] else None
+        inputs['packages'] = [path_stat(host_path(db_path)) for db_path in package_db_paths]
+    elif step_name == 'configure_pam':
+        inputs['profile'] = [profile['configure'], profile['enforce'], get_host_facts()['display_managers'], get_host_facts()['pkcs11_libs']]
+        inputs['vastool'] = path_stat(host_path(vastool_path))
+        inputs['files'] = dict((local_file, path_digest(local_file)) for local_file in managed_paths() + [host_path(vas_conf_path), script_path + '/10-ubuntu.conf'])
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+@contextlib.contextmanager
+def locked_ledger(): # Hold the ledger lock, the image pool updates it from several processes.
+    with open(ledger_path + '.lock', "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_ledger(): # The ledger, or an empty one if it is missing, unreadable or from another layout.
+    try:
+        with open(ledger_path, "r") as ledger_file:
+            ledger = json.load(ledger_file)
+    except (IOError, ValueError):
+        ledger = None
+    if not ledger or ledger.get('version') != ledger_version:
+        ledger = {'version': ledger_version, 'roots': {}}
+    return ledger
+
+def record_step(step_name, fingerprint): # Record the fingerprint a step left the host with after it succeeded.
+    try:
+        with locked_ledger():
+            ledger = read_ledger()
+            ledger['roots'].setdefault(root_path, {})[step_name] = {'fingerprint': fingerprint, 'time': time.strftime("%Y-%m-%dT%H:%M:%S")}
+            write_file_atomic(ledger_path, json.dumps(ledger, indent=2, sort_keys=True))
+    except (IOError, OSError) as e:
+        logger.debug('The ledger could not be written. Error: %s' % e)
+
+def run_step(step_name, function): # Run a ledger step unless nothing it depends on changed since its last success. Returns what the step returned, None when it was skipped.
+    if step_name not in forced_steps and 'all' not in forced_steps:
+        last_success = read_ledger()['roots'].get(root_path, {}).get(step_name, {})
+        if last_success.get('fingerprint') == step_fingerprint(step_name):
+            logger.info(step_name + ' has not changed since it last succeeded at ' + last_success['time'] + ', skipping it. Use --force ' + step_name + ' to run it anyway.')
+            emit_event('skip', step=step_name)
+            return None
+    result = function()
+    if result is not False:
+        record_step(step_name, step_fingerprint(step_name))
+    return result
+
+@instrumented
+def configure_host (): # Run every configuration step in order, skipping the ones the ledger shows are done. This is what each fleet target runs. Returns False if a step failed.
+    check_vastool()
+    packages_installed = True
+    if not offline_root():
+        packages_installed = run_step('package_install', package_install) is not False # install dependencies per OS
+    run_step('configure_pam', configure_pam) # The PAM changes are still made, a later run retries the packages
+    return packages_installed
+
+@instrumented
+def configure_pam (): # Plan the vasd, PAM and display manager changes and apply them after a backup.
+    plan = build_plan()
+    if plan_is_empty(plan):
+        logger.info('This host is already configured for smartcard enforcement. Nothing to change.')
+        return()
+    logger.debug('Planned changes:\n' + format_plan(plan))
+    check_plan_errors(plan)
+    backup_pam(run_backup_targets(plan))
+    apply_plan(plan)
+
+def audit_pam_service(service): # Report whether a PAM service has the smartcard line and, where required, the enforcement line right after it.
+    local_file = pam_path(service)
+    text = read_text(local_file) if has_pam_service(service) else None
+    result = {'service': service, 'path': local_file, 'exists': text is not None, 'enforcement_required': service in host_profile()['enforce']}
+    if text is None:
+        result['compliant'] = True # Nothing to enforce on a service that is not installed
+        return result
+    pam_file = parse_pam_text(local_file, text)
+    smartcard_regex = compile_pattern(smartcard_line)
+    enforce_regex = compile_pattern(line_to_test)
+    rules = pam_file['rules']
+    result['smartcard'] = pam_has(pam_file, smartcard_line)
+    result['enforced'] = pam_has(pam_file, line_to_test)
+    result['ordered'] = result['smartcard'] and result['enforced']
+    for position, rule in enumerate(rules): # The enforcement rule has to follow every pam_vas_smartcard echo_return rule directly
+        if smartcard_regex.match(rule['line']):
+            if position + 1 >= len(rules) or not enforce_regex.match(rules[position + 1]['line']):
+                result['ordered'] = False
+    if result['enforcement_required']:
+        result['compliant'] = result['ordered']
+    else:
+        result['compliant'] = result['smartcard']
+    return result
+
+def audit_displaymanagers(): # Report the MDM IncludeAll setting and the LightDM drop-in.
+    results = {}
+    if 'mdm' in get_host_facts()['display_managers']:
+        defaults = read_text(host_path(mdm_defaults_path))
+        include_all_regex = compile_pattern(mdm_line)
+        include_all = defaults is not None and any(include_all_regex.match(line) for line in defaults.splitlines())
+        results['mdm'] = {'path': host_path(mdm_defaults_path), 'exists': defaults is not None, 'include_all_disabled': defaults is not None and not include_all}
+        results['mdm']['compliant'] = results['mdm']['include_all_disabled']
+    if 'lightdm' in get_host_facts()['display_managers']:
+        dropin_path = host_path(lightdm_conf_dir + '/10-ubuntu.conf')
+        dropin = read_text(dropin_path)
+        shipped = read_text(script_path + '/10-ubuntu.conf')
+        results['lightdm'] = {'path': dropin_path, 'exists': dropin is not None}
+        results['lightdm']['matches'] = dropin is not None and (shipped is None or dropin == shipped) # Only compared when the shipped copy is next to this script
+        results['lightdm']['compliant'] = results['lightdm']['matches']
+    return results
+
+@instrumented
+def audit (): # Read-only compliance check of every PAM service and display manager configuration. Never runs vastool or a package manager.
+    services = [audit_pam_service(service) for service in host_profile()['configure']]
+    displaymanagers = audit_displaymanagers()
+    compliant = all(result['compliant'] for result in services) and all(result['compliant'] for result in displaymanagers.values())
+    return {'host': platform.node(), 'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'compliant': compliant, 'services': services, 'display_managers': displaymanagers}
+
+def inotify_open(): # Open an inotify instance through libc. Returns {'libc', 'fd', 'watches': {watch descriptor: directory}}.
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    fd = libc.inotify_init1(inotify_cloexec)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+    return {'libc': libc, 'fd': fd, 'watches': {}}
+
+def inotify_watch(inotify, directories): # Watch the directories that exist and are not watched yet. Returns the ones that were added.
+    added = []
+    for directory in directories:
+        if directory in inotify['watches'].values() or not os.path.isdir(directory):
+            continue
+        watch_descriptor = inotify['libc'].inotify_add_watch(inotify['fd'], directory, inotify_mask)
+        if watch_descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_add_watch ' + directory + ': ' + os.strerror(error))
+        inotify['watches'][watch_descriptor] = directory
+        added.append(directory)
+    return added
+
+def inotify_read(inotify): # Block until inotify has events and return the paths they name, or None if the kernel dropped events.
+    watches = inotify['watches']
+    buffer = os.read(inotify['fd'], 65536)
+    paths = []
+    offset = 0
+    while offset + 16 <= len(buffer): # struct inotify_event: int wd, uint32 mask, cookie, len, then len bytes of name
+        watch_descriptor, mask, cookie, name_length = struct.unpack_from('iIII', buffer, offset)
+        name = buffer[offset + 16:offset + 16 + name_length].rstrip('\0')
+        offset += 16 + name_length
+        if mask & inotify_overflow:
+            return None
+        if watch_descriptor in watches and name:
+            paths.append(os.path.join(watches[watch_descriptor], name))
+    return paths
+
+def watched_directories(): # Directories holding the files the watcher keeps enforced.
+    return [host_path('/etc/pam.d'), os.path.dirname(host_path(mdm_defaults_path)), host_path(lightdm_conf_dir)]
+
+def managed_paths(): # Every file the watcher keeps enforced: the profile's PAM services and the display manager configs.
+    return [pam_path(service) for service in host_profile()['backup']] + [host_path(mdm_defaults_path), host_path(lightdm_conf_dir + '/10-ubuntu.conf')]
+
+def build_drift_plan(changed, vastool_done=False): # Plan the configuration of the changed files only, with the same checks a full run makes.
+    plan = new_plan(vastool_done or offline_root())
+    profile = host_profile()
+    display_managers = get_host_facts()['display_managers']
+    for local_file in changed:
+        service = os.path.basename(local_file)
+        if local_file == pam_path(service):
+            if service in profile['configure']:
+                plan_smartcard_service(plan, service)
+            if service == 'mdm' and 'mdm' in display_managers:
+                plan_mdm(plan)
+            if service in profile['enforce']:
+                manipulate_pam_files(plan, local_file, line_to_test)
+        elif local_file == host_path(mdm_defaults_path) and 'mdm' in display_managers:
+            plan_mdm(plan)
+        elif local_file == host_path(lightdm_conf_dir + '/10-ubuntu.conf') and 'lightdm' in display_managers:
+            plan_lightdm(plan)
+    return plan
+
+@instrumented
+def correct_drift(changed): # Re-check the changed files and put back the configuration they lost in one transaction. Returns True if anything was changed.
+    global host_facts
+    host_facts = None # Services may have been installed or removed, the facts are checked against their mtimes again
+    plan = build_drift_plan(changed)
+    emit_event('drift', files=changed, corrected=not plan_is_empty(plan))
+    if plan_is_empty(plan):
+        logger.debug('No drift in ' + ', '.join(changed))
+        return False
+    drifted = [operation['target'] for operation in plan['vastool']] + [local_file for local_file, entry in plan_changes(plan)]
+    logger.info('Drift detected, correcting ' + ', '.join(local_file for n, local_file in enumerate(drifted) if local_file not in drifted[:n]))
+    logger.debug('Planned changes:\n' + format_plan(plan))
+    check_plan_errors(plan)
+    backup_pam(plan_targets(plan))
+    apply_plan(plan, functools.partial(build_drift_plan, changed))
+    return True
+
+def watch(): # Correct drift on every managed file as soon as it changes, until interrupted. Blocks in read() while nothing changes.
+    check_vastool()
+    inotify = inotify_open()
+    changed = managed_paths() # Drift from before the watcher started is corrected first
+    try:
+        while True:
+            added = inotify_watch(inotify, watched_directories()) # Before every check, a correction may have created the LightDM drop-in directory
+            if added:
+                logger.info('Watching ' + ', '.join(added) + ' for smartcard configuration drift.')
+            if changed is None:
+                logger.warning('inotify dropped events, checking every managed file.')
+                changed = managed_paths()
+            try:
+                correct_drift([local_file for n, local_file in enumerate(changed) if local_file not in changed[:n]])
+            except SystemExit as e: # A failed plan or vastool run has been rolled back and logged, keep watching. A signal stops the watcher.
+                if e.code != 1:
+                    raise
+                logger.error('***Drift could not be corrected, still watching.***')
+            if [directory for directory in watched_directories() if os.path.isdir(directory) and directory not in inotify['watches'].values()]:
+                changed = managed_paths() # Check once more now that the new directory is watched
+                continue
+            changed = inotify_read(inotify)
+            while changed is not None and select.select([inotify['fd']], [], [], watch_settle)[0]: # Wait for the change to settle
+                more = inotify_read(inotify)
+                changed = None if more is None else changed + more
+    except KeyboardInterrupt:
+        logger.info('Watch stopped.')
+    finally:
+        os.close(inotify['fd'])
+    return 0
+
+def read_inventory(inventory_path): # Read fleet targets, one per line: <target> [QAS directory on the target]. Lines starting with # are ignored.
+    targets = []
+    with open(inventory_path, "r") as inventory:
+        for line in inventory:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            targets.append({'target': fields[0], 'directory': fields[1] if len(fields) > 1 else script_path})
+    return targets
+
+def fleet_command(target, directory, action): # Build the command that runs this script's action on a target, the script itself is sent on stdin.
+    remote = 'cd ' + pipes.quote(directory) + ' && ' + remote_python + ' - --assume-yes ' + action
+    if target == 'local':
+        return ['sh', '-c', remote]
+    if target.startswith('chroot:'): # chroot:/path/to/root, for local testing against a mounted image
+        return ['chroot', target[len('chroot:'):], 'sh', '-c', remote]
+    if target.startswith('docker:'): # docker:container, for local testing against a container
+        return ['docker', 'exec', '-i', target[len('docker:'):], 'sh', '-c', remote]
+    if target.startswith('ssh://'):
+        target = target[len('ssh://'):]
+    return ['ssh', '-o', 'BatchMode=yes', target, 'sudo -n sh -c ' + pipes.quote(remote)]
+
+def configure_fleet_host(host, retries, script_source, action): # Run action on one fleet target, retrying on failure, and return its result.
+    command = fleet_command(host['target'], host['directory'], action)
+    result = {'target': host['target'], 'returncode': None, 'attempts': 0, 'duration': 0.0, 'output': ''}
+    start = time.time()
+    while result['attempts'] <= retries:
+        result['attempts'] += 1
+        command_result = run_command(command, capture=True, timeout=fleet_timeout, stdin_data=script_source, name=host['target'])
+        result['returncode'] = command_result['returncode']
+        result['output'] = command_result['output'] + command_result['errors'] + (command_result['stopped'] or '')
+        if result['returncode'] == 0:
+            break
+        logger.info(host['target'] + ' attempt ' + str(result['attempts']) + ' failed with exit code ' + str(result['returncode']))
+    result['duration'] = time.time() - start
+    return result
+
+def run_fleet(inventory_path, workers, retries, report_path, action='configure'): # Configure (or unconfigure) every inventory target with a bounded pool of workers and report per-host results.
+    hosts = read_inventory(inventory_path)
+    if not hosts:
+        logger.error('No targets found in ' + inventory_path)
+        return 1
+    with open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', "r") as script_file:
+        script_source = script_file.read()
+    work = Queue.Queue()
+    for position, host in enumerate(hosts):
+        work.put((position, host))
+    results = [None] * len(hosts) # Kept in inventory order
+    def worker():
+        while True:
+            try:
+                position, host = work.get_nowait()
+            except Queue.Empty:
+                return
+            result = configure_fleet_host(host, retries, script_source, action)
+            results[position] = result
+            emit_event('host', target=host['target'], returncode=result['returncode'], attempts=result['attempts'], duration=result['duration'])
+            logger.info(host['target'] + (' ' + action + ' done' if result['returncode'] == 0 else ' FAILED') + ' in %.1fs' % result['duration'])
+    start = time.time()
+    threads = [threading.Thread(target=worker) for n in range(min(workers, len(hosts)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    failed = [result for result in results if result['returncode'] != 0]
+    logger.info('Fleet summary: %d hosts, %d configured, %d failed in %.1fs' % (len(results), len(results) - len(failed), len(failed), time.time() - start))
+    for result in failed:
+        logger.error(result['target'] + ' failed after ' + str(result['attempts']) + ' attempts:\n' + result['output'][-2000:])
+    if report_path:
+        with open(report_path, "w") as report:
+            json.dump(results, report, indent=2)
+        logger.info('Fleet report written to ' + report_path)
+    return 1 if failed else 0
+
+def configure_image(image_root): # Configure one mounted image root in a pool process and return its result. Each process has its own root_path and host facts.
+    start = time.time()
+    set_root(image_root)
+    result = {'root': image_root, 'returncode': 0, 'error': '', 'compliant': False}
+    try:
+        if not configure_host():
+            result['returncode'] = 1
+        result['compliant'] = audit()['compliant']
+    except SystemExit as e: # exit_script() after an error that has been logged
+        result['returncode'] = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        result['returncode'] = 1
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        logger.error(image_root + ' failed: ' + result['error'])
+    result['duration'] = time.time() - start
+    return result
+
+def run_images(image_roots, workers, report_path): # Configure every image root offline with a pool of worker processes and report per-root results.
+    start = time.time()
+    pool = multiprocessing.Pool(max(1, min(workers, len(image_roots))))
+    try:
+        results = pool.map_async(configure_image, [os.path.abspath(image_root) for image_root in image_roots]).get(86400) # A timeout keeps Ctrl-C working while waiting
+    finally:
+        pool.terminate()
+        pool.join()
+    for result in results:
+        emit_event('image', root=result['root'], returncode=result['returncode'], compliant=result['compliant'], duration=result['duration'])
+    failed = [result for result in results if result['returncode'] != 0 or not result['compliant']]
+    logger.info('Image summary: %d roots, %d configured, %d failed in %.1fs' % (len(results), len(results) - len(failed), len(failed), time.time() - start))
+    for result in failed:
+        logger.error(result['root'] + ' is not configured ' + (result['error'] or '(exit status %d)' % result['returncode']))
+    if report_path:
+        with open(report_path, "w") as report:
+            json.dump(results, report, indent=2)
+        logger.info('Image report written to ' + report_path)
+    return 1 if failed else 0
+
+def build_option_parser (): # Options that come before the command. main() parses them on their own to find out whether a command was given.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-d', '--debug', action='store_true', help='enable debugging mode')
+    parser.add_argument('-y', '--assume-yes', action='store_true', help='answer yes to every prompt')
+    parser.add_argument('--root', default='/', help='configure, plan or audit the filesystem mounted at ROOT instead of the running host')
+    parser.add_argument('--timeout', type=int, default=command_timeout, metavar='SECONDS', help='stop an external command that runs longer than this')
+    parser.add_argument('--package-timeout', type=int, default=package_timeout, metavar='SECONDS', help='stop a package install or the QAS installer that runs longer than this')
+    parser.add_argument('--force', action='append', default=[], choices=ledger_steps + ['all'], metavar='STEP', help='run STEP even if the ledger shows nothing changed since it last succeeded: ' + ', '.join(ledger_steps) + ' or all. Can be repeated')
+    parser.add_argument('--log-dir', default=log_dir, help='directory the log file is written to')
+    parser.add_argument('--events', metavar='FILE', help='append a JSON line to FILE for every step, command and file write')
+    parser.add_argument('--profile', action='store_true', help='log the time, commands and bytes written per step at the end of the run')
+    return parser
+
+def build_parser (): # Command line options.
+    parser = argparse.ArgumentParser(description='Install QAS and enforce smartcard login. Runs the interactive install when no command is given.', parents=[build_option_parser()])
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.add_parser('install', help='install QAS, then configure smartcard enforcement (the default)')
+    commands.add_parser('configure', help='configure smartcard enforcement on a host that already has QAS')
+    commands.add_parser('audit', help='print a JSON compliance report without changing anything, exit status 1 if the host is not compliant')
+    commands.add_parser('plan', help='show the vastool commands and file diffs a configuration run would make')
+    watch_parser = commands.add_parser('watch', help='keep running and correct smartcard configuration drift as soon as a PAM or display manager file changes')
+    watch_parser.add_argument('--settle', type=float, default=watch_settle, metavar='SECONDS', help='quiet period after a change before it is checked')
+    commands.add_parser('unconfigure', help='remove the smartcard enforcement this script added and print what changed as JSON, QAS stays installed')
+    commands.add_parser('remove', help='remove the smartcard enforcement and QAS')
+    commands.add_parser('backups', help='list the backup runs that can be restored')
+    restore_parser = commands.add_parser('restore', help='restore every file saved by a backup run')
+    restore_parser.add_argument('run', help="backup run to restore, 'latest' for the newest")
+    images_parser = commands.add_parser('images', help='configure mounted image roots offline, several at the same time')
+    images_parser.add_argument('roots', nargs='+', metavar='ROOT', help='root directory of a mounted image or container filesystem')
+    images_parser.add_argument('--workers', type=int, default=image_workers, help='number of image roots configured at the same time')
+    images_parser.add_argument('--report', metavar='FILE', help='write the per-root results to FILE as JSON')
+    fleet_parser = commands.add_parser('fleet', help='configure every target listed in an inventory file concurrently')
+    fleet_parser.add_argument('inventory', help='inventory file, one target per line')
+    fleet_parser.add_argument('--action', choices=['configure', 'unconfigure'], default='configure', help='unconfigure rolls the smartcard enforcement back on every target')
+    fleet_parser.add_argument('--workers', type=int, default=fleet_workers, help='number of fleet targets configured at the same time')
+    fleet_parser.add_argument('--retries', type=int, default=fleet_retries, help='number of times a failed fleet target is retried')
+    fleet_parser.add_argument('--report', metavar='FILE', help='write the per-host fleet results to FILE as JSON')
+    fleet_parser.add_argument('--host-timeout', type=int, default=fleet_timeout, metavar='SECONDS', help='stop a fleet target that takes longer than this')
+    fleet_parser.add_argument('--remote-python', default=remote_python, help='python 2.7 interpreter to run on fleet targets')
+    return parser
+
+def main (argv=None): # Command line entry point. Nothing runs when this module is imported.
+    global debug_flag, assume_yes, log_dir, events_file, profile_enabled, command_timeout, package_timeout, forced_steps
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not build_option_parser().parse_known_args(argv)[1]: # Only options, -h and commands are left over
+        argv.append('install')
+    args = build_parser().parse_args(argv)
+    debug_flag = args.debug
+    assume_yes = args.assume_yes
+    log_dir = args.log_dir
+    command_timeout = args.timeout
+    forced_steps = args.force
+    package_timeout = args.package_timeout
+    profile_enabled = args.profile
+    set_root(args.root)
+    setup_logging()
+    if args.events:
+        events_file = open(args.events, "a")
+    try:
+        return run_command_line(args)
+    finally:
+        if profile_enabled:
+            log_profile()
+        if events_file is not None:
+            events_file.close()
+            events_file = None
+
+def run_command_line (args): # Run the command chosen on the command line and return its exit status.
+    global dist_name, dist_version, remote_python, watch_settle, fleet_timeout, facts_cache_writable
+    facts_cache_writable = args.command not in read_only_commands
+    facts = get_host_facts()
+    dist_name = facts['dist_name']
+    dist_version = facts['dist_version']
+    if args.command == 'audit':
+        report = audit()
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return 0 if report['compliant'] else 1
+    if args.command == 'plan':
+        print(format_plan(build_plan()) or 'No changes are needed.')
+        return 0
+    if args.command == 'backups':
+        for manifest in list_backups():
+            print(manifest['run'] + '  ' + manifest['time'] + '  ' + ' '.join(entry['path'] for entry in manifest['files']))
+        return 0
+    setup_log_file()
+    if args.command == 'restore':
+        return 0 if restore_backup(args.run) else 1
+    if args.command == 'images':
+        return run_images(args.roots, args.workers, args.report)
+    if args.command == 'fleet':
+        remote_python = args.remote_python
+        fleet_timeout = args.host_timeout
+        return run_fleet(args.inventory, args.workers, args.retries, args.report, args.action)
+    if args.command == 'watch':
+        watch_settle = args.settle
+        return watch()
+    if args.command == 'unconfigure':
+        print(json.dumps(unconfigure_host(), indent=2, sort_keys=True))
+        return 0
+    if args.command == 'remove':
+        if not ask_yes_no("***Would you like to remove QAS? (yes/no)***"):
+            return 0
+        return remove_qas()
+    check_os()
+    succeeded = True
+    if args.command == 'install':
+        ask_continue()
+        if ask_install(): # A declined install is a normal choice, not a failed step
+            succeeded = run_step('installqas', installqas) is not False
+        remove()
+    succeeded = configure_host() and succeeded
+    print(outro_text)
+    return 0 if succeeded else 1
 #
 # END OF FUNCTIONS DEFINITION
 #
@@ -430,30 +1722,8 @@ def backup_pam (file_to_backup): # Function to backup PAM files.
 # PROGRAM DEFINITION
 #
 
-check_os()
-ask_continue()
-installqas()
-remove()
-check_vastool()
-backup_pam('/etc/pam.d/password-auth')# Backups for password-auth PAM file used in Cent/RHEL/OpenSuse
-backup_pam('/etc/pam.d/login')# Backups for login PAM file used in all OS's
-backup_pam('/etc/pam.d/gdm-password')# Backups for gdm-password PAM file used in Cent/RHEL/OpenSuse
-backup_pam('/etc/pam.d/gdm-smartcard')# Backups for gdm-password PAM file used in Cent/RHEL/OpenSuse
-backup_pam('/etc/pam.d/lightdm')# Backups for lightdm PAM file used in Ubuntu and Mint
-backup_pam('/etc/pam.d/lightdm-greeter')# Backups for lightdm-greeter PAM file used in Ubuntu and Mint
-backup_pam('/etc/pam.d/common-auth')# Backups for common-auth PAM file used in Ubuntu and Mint
-backup_pam('/usr/share/mdm/defaults.conf')# Backups for mdm/defaults.conf PAM file used in Ubuntu and Mint
-package_install()# install dependencies per OS
-vasd_config()
-check_displaymanagers()
-manipulate_pam_files('/etc/pam.d/password-auth', line_to_test) # Used in Cent/RHEL/OpenSuse for SSH and Lock-Screen (commented out until ssh issues are resolved) REMOVE THIS TO ENFORCE
-manipulate_pam_files('/etc/pam.d/login', line_to_test) # Used on all Linux Systems
-manipulate_pam_files('/etc/pam.d/lightdm', line_to_test) # Used with Ubuntu and Mint primarily
-manipulate_pam_files('/etc/pam.d/mdm', line_to_test) # Used on Mint primarily # covered with common-auth
-manipulate_pam_files('/etc/pam.d/lightdm-greeter', line_to_test) # Used with Ubuntu and Mint
-manipulate_pam_files('/etc/pam.d/common-auth', line_to_test) # Used with Ubuntu and Mint SSH and Lock-Screen (commented out until ssh issues are resolved) REMOVE THIS TO ENFORCE
-print(outro_text)
-exit_script(0)
+if __name__ == '__main__':
+    exit_script(main())
 
 #
 # END OF PROGRAM DEFINITION
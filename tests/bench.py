@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Time configure, a second run, audit and unconfigure on generated PAM trees of every distro layout, large and small,
+# and check every file byte for byte. Run from the repository root with: python tests/bench.py [--lines 20,2000] [--services 40,400]
+#
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyvassc
+
+bench_layouts = collections.OrderedDict([ # os-release NAME and the PAM services each generated distro layout has
+    ('centos', ('CentOS Linux', ['login', 'password-auth', 'password-auth-ac', 'smartcard-auth', 'smartcard-auth-ac', 'gdm', 'gdm-password', 'gdm-smartcard-ac'])),
+    ('ubuntu', ('Ubuntu', ['login', 'common-auth', 'lightdm', 'lightdm-greeter', 'gdm-password'])),
+    ('suse', ('openSUSE Leap', ['login', 'common-auth', 'common-auth-pc', 'common-auth-smartcard', 'password-auth', 'gdm'])),
+    ('mint', ('Linux Mint', ['login', 'common-auth', 'mdm', 'lightdm', 'lightdm-greeter'])),
+])
+nopasswdlogin = 'auth\tsufficient\tpam_succeed_if.so user ingroup nopasswdlogin\n' # MDM rule the smartcard pair goes after
+smartcard = ['auth\tsufficient\tpam_vas_smartcard.so\n', 'auth\trequisite\tpam_vas_smartcard.so echo_return\n'] # As vastool writes it
+enforced = 'auth    [success=ok default=die]    pam_localuser.so\n' # What configure has to insert after it
+
+def bench_pam_text(profile, service, lines): # Generated PAM file for service with about lines rules, and the file configure has to turn it into under profile.
+    top = ['#%PAM-1.0\n'] + ['auth       optional   pam_bench_auth.so n=%d\n' % n for n in range(lines // 2)]
+    bottom = ['session    optional   pam_bench_session.so n=%d\n' % n for n in range(lines - lines // 2)]
+    if service == 'mdm': # MDM is left without pam_vas_smartcard so the MDM insertion runs
+        source = top + [nopasswdlogin] + bottom
+        expected = top + [nopasswdlogin] + smartcard + [enforced] + bottom
+    elif service in profile['configure']:
+        source = top + smartcard + bottom
+        expected = top + smartcard + ([enforced] if service in profile['enforce'] else []) + bottom
+    else:
+        source = expected = top + bottom
+    return ''.join(source), ''.join(expected)
+
+def bench_tree(tree_root, layout, lines, extra_services): # Write a generated host tree under tree_root and return {path: contents as written} and {path: expected contents after configure}.
+    dist_name, services = bench_layouts[layout]
+    profile = pyvassc.match_profile(dist_name)
+    sources = {}
+    expected = {}
+    def write(path, contents, after=None):
+        full_path = os.path.join(tree_root, path.lstrip('/'))
+        if not os.path.exists(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, "w") as tree_file:
+            tree_file.write(contents)
+        sources[full_path] = contents
+        expected[full_path] = contents if after is None else after
+    write('/etc/os-release', 'NAME="' + dist_name + '"\nVERSION_ID="1"\n')
+    write('/opt/quest/bin/vastool', '')
+    write('/etc/opt/quest/vas/vas.conf', '[vasd]\n username-attr-name = samAccountName\n allow-upn-login = True\n')
+    for service in services + ['bench-%d' % n for n in range(extra_services)]:
+        source, after = bench_pam_text(profile, service, lines)
+        write('/etc/pam.d/' + service, source, after)
+    if 'mdm' in services:
+        write('/usr/share/mdm/defaults.conf', '[greeter]\nIncludeAll=true\nInclude=\n', '[greeter]\nIncludeAll=false\nInclude=\n')
+    if 'lightdm' in services:
+        drop_in = os.path.join(tree_root, 'etc/lightdm/lightdm.conf.d/10-ubuntu.conf')
+        sources[drop_in] = None
+        expected[drop_in] = pyvassc.read_text(pyvassc.script_path + '/10-ubuntu.conf')
+    return sources, expected
+
+def run_bench(line_counts, service_counts): # Time every layout and size and return 1 if any tree came out wrong.
+    bench_dir = tempfile.mkdtemp(prefix='pyvassc-bench-')
+    pyvassc.facts_cache_path = bench_dir + '/facts.json'
+    pyvassc.logger.setLevel(logging.WARNING)
+    failures = 0
+    print('%-8s %6s %8s %6s %10s %10s %10s %10s %11s  %s' % ('layout', 'lines', 'services', 'files', 'bytes', 'configure', 'rerun', 'audit', 'unconfigure', 'result'))
+    try:
+        for layout in bench_layouts:
+            for lines in line_counts:
+                for extra_services in service_counts:
+                    tree_root = os.path.join(bench_dir, '%s-%d-%d' % (layout, lines, extra_services))
+                    sources, expected = bench_tree(tree_root, layout, lines, extra_services)
+                    pyvassc.backup_dir = tree_root + '.backups'
+                    pyvassc.ledger_path = tree_root + '.ledger.json'
+                    pyvassc.set_root(tree_root)
+                    start = time.time()
+                    pyvassc.configure_host()
+                    configure_time = time.time() - start
+                    start = time.time()
+                    rerun_plan = pyvassc.build_plan()
+                    rerun_time = time.time() - start
+                    start = time.time()
+                    report = pyvassc.audit()
+                    audit_time = time.time() - start
+                    problems = [path for path, contents in expected.items() if pyvassc.read_text(path) != contents]
+                    if not pyvassc.plan_is_empty(rerun_plan):
+                        problems.append('second run is not a no-op')
+                    if not report['compliant']:
+                        problems.append('audit reports non-compliant')
+                    start = time.time()
+                    pyvassc.unconfigure_host()
+                    unconfigure_time = time.time() - start
+                    if [path for path, contents in sources.items() if pyvassc.read_text(path) != contents]:
+                        problems.append('unconfigure did not restore the original files')
+                    failures += 1 if problems else 0
+                    total_bytes = sum(len(contents) for contents in expected.values())
+                    print('%-8s %6d %8d %6d %10d %9.3fs %9.3fs %9.3fs %10.3fs  %s' % (layout, lines, extra_services, len(expected), total_bytes, configure_time, rerun_time, audit_time, unconfigure_time, 'ok' if not problems else 'FAILED: ' + ', '.join(problems)))
+    finally:
+        pyvassc.set_root('/')
+        shutil.rmtree(bench_dir)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time configure, audit and unconfigure on generated PAM trees and check the output byte for byte.')
+    parser.add_argument('--lines', default='20,2000', help='comma separated PAM file sizes in lines')
+    parser.add_argument('--services', default='40,400', help='comma separated numbers of extra PAM services per tree')
+    args = parser.parse_args()
+    sys.exit(run_bench([int(lines) for lines in args.lines.split(',')], [int(services) for services in args.services.split(',')]))
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+#
+# Regression tests for pyvassc.py. Each distro under trees/ has a host tree as vastool leaves it (before), and the tree a
+# configuration run (configured) and a following unconfigure run (unconfigured) must produce from it, byte for byte.
+# Run from the repository root with: python -m unittest discover -s tests
+#
+
+import logging
+import os
+import shutil
+import signal
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+tests_path = os.path.dirname(os.path.abspath(__file__)) # Location of the tests and their trees
+sys.path.insert(0, os.path.dirname(tests_path))
+
+import pyvassc
+
+trees_path = tests_path + '/trees' # One directory per distro layout holding its before, configured and unconfigured trees
+distros = ['centos', 'ubuntu', 'suse', 'mint'] # Layouts with golden trees
+
+def read_tree(tree_root): # {relative path: contents} of every file under tree_root.
+    files = {}
+    for directory, _, names in os.walk(tree_root):
+        for name in names:
+            full_path = os.path.join(directory, name)
+            with open(full_path, "r") as tree_file:
+                files[os.path.relpath(full_path, tree_root)] = tree_file.read()
+    return files
+
+class TreeTestCase(unittest.TestCase): # Runs every test on a copy of a golden tree, with the backup store, ledger and facts cache kept out of the repository.
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='pyvassc-test-')
+        self.saved = (pyvassc.backup_dir, pyvassc.ledger_path, pyvassc.facts_cache_path, pyvassc.logger.level)
+        pyvassc.backup_dir = self.work_dir + '/backups'
+        pyvassc.ledger_path = self.work_dir + '/ledger.json'
+        pyvassc.facts_cache_path = self.work_dir + '/facts.json'
+        pyvassc.logger.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        pyvassc.set_root('/')
+        pyvassc.backup_dir, pyvassc.ledger_path, pyvassc.facts_cache_path, level = self.saved
+        pyvassc.logger.setLevel(level)
+        shutil.rmtree(self.work_dir)
+
+    def use_tree(self, distro, name='before'): # Copy a golden tree into the work directory and point the script at it.
+        tree_root = self.work_dir + '/' + distro
+        shutil.copytree(os.path.join(trees_path, distro, name), tree_root)
+        pyvassc.set_root(tree_root)
+        return tree_root
+
+    def assertTree(self, tree_root, distro, name): # Every file of the golden tree and no other file, byte for byte.
+        expected = read_tree(os.path.join(trees_path, distro, name))
+        actual = read_tree(tree_root)
+        self.assertEqual(sorted(actual), sorted(expected))
+        for path in sorted(expected):
+            self.assertEqual(actual[path], expected[path], path + ' differs from the ' + name + ' tree of ' + distro)
+
+class ConfigureTest(TreeTestCase): # configure, a second run, audit and unconfigure against the golden trees of every distro.
+
+    def check_distro(self, distro):
+        tree_root = self.use_tree(distro)
+        self.assertNotEqual(pyvassc.configure_host(), False)
+        self.assertTree(tree_root, distro, 'configured')
+        self.assertTrue(pyvassc.plan_is_empty(pyvassc.build_plan()), 'a second run of ' + distro + ' is not a no-op')
+        self.assertTrue(pyvassc.audit()['compliant'])
+        pyvassc.unconfigure_host()
+        self.assertTree(tree_root, distro, 'unconfigured')
+
+    def test_centos(self):
+        self.check_distro('centos')
+
+    def test_ubuntu(self):
+        self.check_distro('ubuntu')
+
+    def test_suse(self):
+        self.check_distro('suse')
+
+    def test_mint(self):
+        self.check_distro('mint')
+
+    def test_unconfigured_tree_is_planned_again(self): # Unconfigure leaves nothing behind that would make the next run skip a file.
+        for distro in distros:
+            self.use_tree(distro, 'unconfigured')
+            self.assertFalse(pyvassc.plan_is_empty(pyvassc.build_plan()), distro)
+            pyvassc.set_root('/')
+
+class OfflineTest(TreeTestCase): # Under --root and images vastool would change the running host, so a vas.conf without the vasd settings or PKCS#11 library is left alone.
+
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        self.commands = []
+        self.saved_run_command = pyvassc.run_command
+        pyvassc.run_command = lambda args, **kwargs: self.commands.append(args) or {'returncode': 1, 'output': '', 'errors': '', 'stopped': None}
+
+    def tearDown(self):
+        pyvassc.run_command = self.saved_run_command
+        TreeTestCase.tearDown(self)
+
+    def test_configure(self):
+        tree_root = self.use_tree('centos-bare')
+        self.assertNotEqual(pyvassc.configure_host(), False)
+        self.assertTree(tree_root, 'centos-bare', 'configured')
+        self.assertTrue(pyvassc.plan_is_empty(pyvassc.build_plan()))
+        pyvassc.unconfigure_host()
+        self.assertTree(tree_root, 'centos-bare', 'unconfigured')
+        self.assertEqual(self.commands, [])
+
+    def test_image(self):
+        tree_root = self.use_tree('centos-bare')
+        result = pyvassc.configure_image(tree_root)
+        self.assertEqual((result['returncode'], result['compliant']), (0, True))
+        self.assertTree(tree_root, 'centos-bare', 'configured')
+        self.assertEqual(self.commands, [])
+
+class ProfileTest(TreeTestCase): # The distro profiles decide what is configured and enforced, a new profile is only a data change.
+
+    def test_profiles_differ(self):
+        self.assertIn('common-auth', pyvassc.match_profile('Ubuntu')['enforce'])
+        self.assertNotIn('common-auth', pyvassc.match_profile('CentOS Linux')['enforce'])
+        self.assertIn('lightdm', pyvassc.match_profile('CentOS Linux')['enforce'])
+        self.assertIn('mdm', pyvassc.match_profile('Ubuntu')['enforce'])
+        self.assertEqual(pyvassc.match_profile('Plan 9')['enforce'], pyvassc.baseline_services['enforce'])
+
+    def test_new_profile(self):
+        profile = dict(pyvassc.match_profile('Ubuntu'), match='Ubuntu', configure=['login'], enforce=['login'])
+        pyvassc.distro_profiles.insert(0, profile)
+        try:
+            tree_root = self.use_tree('ubuntu')
+            pyvassc.configure_host()
+        finally:
+            pyvassc.distro_profiles.remove(profile)
+        changed = read_tree(tree_root)
+        before = read_tree(trees_path + '/ubuntu/before')
+        configured = read_tree(trees_path + '/ubuntu/configured')
+        self.assertEqual(sorted(path for path in changed if changed[path] != before.get(path)), ['etc/lightdm/lightdm.conf.d/10-ubuntu.conf', 'etc/pam.d/login'])
+        self.assertEqual(changed['etc/pam.d/login'], configured['etc/pam.d/login'])
+
+class PackageInstallTest(TreeTestCase): # The dependencies are installed even when the VASSC package file is not next to the script.
+
+    stubbed = ['installed_packages', 'run_command', 'start_privileged_session', 'run_vastool_batch', 'script_path']
+
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        self.saved_functions = dict((name, getattr(pyvassc, name)) for name in self.stubbed)
+        self.commands = []
+        pyvassc.installed_packages = lambda manager, names: ['coolkey']
+        pyvassc.run_command = lambda args, **kwargs: self.commands.append(args) or {'returncode': 0}
+        pyvassc.start_privileged_session = lambda: True
+        pyvassc.run_vastool_batch = lambda: []
+        pyvassc.script_path = self.work_dir
+        self.use_tree('centos')
+        self.vassc_path = self.work_dir + '/' + pyvassc.host_profile()['vassc']
+
+    def tearDown(self):
+        for name, value in self.saved_functions.items():
+            setattr(pyvassc, name, value)
+        TreeTestCase.tearDown(self)
+
+    def test_vassc_missing(self):
+        self.assertEqual(pyvassc.package_install(), False)
+        self.assertEqual(len(self.commands), 1)
+        self.assertIn('opensc', self.commands[0])
+        self.assertNotIn('coolkey', self.commands[0])
+        self.assertNotIn(self.vassc_path, self.commands[0])
+
+    def test_vassc_present(self):
+        os.makedirs(os.path.dirname(self.vassc_path))
+        open(self.vassc_path, "w").close()
+        self.assertNotEqual(pyvassc.package_install(), False)
+        self.assertIn(self.vassc_path, self.commands[0])
+
+class MdmTest(TreeTestCase): # The MDM smartcard pair and the enforcement line go right after the nopasswdlogin rule, and come out again on unconfigure.
+
+    nopasswdlogin = 'auth\tsufficient\tpam_succeed_if.so user ingroup nopasswdlogin\n'
+    inserted = ['auth\tsufficient\tpam_vas_smartcard.so\n', 'auth\trequisite\tpam_vas_smartcard.so echo_return\n', 'auth    [success=ok default=die]    pam_localuser.so\n']
+
+    def test_insertion(self):
+        tree_root = self.use_tree('mint')
+        pyvassc.configure_host()
+        with open(tree_root + '/etc/pam.d/mdm', "r") as mdm_file:
+            lines = mdm_file.readlines()
+        index = lines.index(self.nopasswdlogin)
+        self.assertEqual(lines[index + 1:index + 4], self.inserted)
+        self.assertEqual(len(lines), len(read_tree(trees_path + '/mint/before')['etc/pam.d/mdm'].splitlines()) + 3)
+
+    def test_insertion_is_not_repeated(self):
+        tree_root = self.use_tree('mint', 'configured')
+        self.assertTrue(pyvassc.plan_is_empty(pyvassc.build_plan()))
+        pyvassc.configure_host()
+        self.assertTree(tree_root, 'mint', 'configured')
+
+    def test_includeall_set_by_administrator(self): # Unconfigure only reverts an IncludeAll=false that a backup shows this script made.
+        tree_root = self.use_tree('mint')
+        defaults = tree_root + '/usr/share/mdm/defaults.conf'
+        with open(defaults, "r") as defaults_file:
+            contents = defaults_file.read().replace('IncludeAll=true', 'IncludeAll=false')
+        with open(defaults, "w") as defaults_file:
+            defaults_file.write(contents)
+        pyvassc.configure_host()
+        removed = pyvassc.unconfigure_host()
+        self.assertNotIn(defaults, removed)
+        self.assertEqual(read_tree(tree_root)['usr/share/mdm/defaults.conf'], contents)
+
+    def test_includeall_without_backup(self):
+        tree_root = self.use_tree('mint', 'configured')
+        pyvassc.unconfigure_host()
+        self.assertEqual(read_tree(tree_root)['usr/share/mdm/defaults.conf'], read_tree(trees_path + '/mint/configured')['usr/share/mdm/defaults.conf'])
+
+    def test_includeall(self):
+        tree_root = self.use_tree('mint')
+        pyvassc.configure_host()
+        with open(tree_root + '/usr/share/mdm/defaults.conf', "r") as defaults_file:
+            self.assertIn('IncludeAll=false\n', defaults_file.readlines())
+
+class CheckExistsTest(unittest.TestCase): # check_exists matches the enforcement rule itself, not its spacing or a comment.
+
+    enforce_pattern = r'auth\s+\[success=ok default=die\]\s+pam_localuser\.so'
+
+    def parse(self, text):
+        return pyvassc.parse_pam_text('/etc/pam.d/test', text)
+
+    def setUp(self):
+        self.level = pyvassc.logger.level
+        pyvassc.logger.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        pyvassc.logger.setLevel(self.level)
+
+    def test_present(self):
+        self.assertTrue(pyvassc.check_exists(self.parse('auth\tsufficient\tpam_vas_smartcard.so\nauth    [success=ok default=die]    pam_localuser.so\n'), self.enforce_pattern))
+
+    def test_other_spacing(self):
+        self.assertTrue(pyvassc.check_exists(self.parse('auth [success=ok default=die] pam_localuser.so\n'), self.enforce_pattern))
+
+    def test_absent(self):
+        self.assertFalse(pyvassc.check_exists(self.parse('auth\tsufficient\tpam_vas_smartcard.so\nauth\trequired\tpam_unix.so\n'), self.enforce_pattern))
+
+    def test_commented_out(self):
+        self.assertFalse(pyvassc.check_exists(self.parse('#auth    [success=ok default=die]    pam_localuser.so\n'), self.enforce_pattern))
+
+    def test_golden_trees(self): # Every service the configured trees enforce has the line, none of the before trees' unenforced ones do.
+        before = self.parse(read_tree(trees_path + '/centos/before')['etc/pam.d/login'])
+        after = self.parse(read_tree(trees_path + '/centos/configured')['etc/pam.d/login'])
+        self.assertFalse(pyvassc.check_exists(before, self.enforce_pattern))
+        self.assertTrue(pyvassc.check_exists(after, self.enforce_pattern))
+
+class BackupTest(TreeTestCase): # backup_pam stores what a run changes, restore_backup puts contents and modes back and refuses a damaged store.
+
+    def test_configure_then_restore(self):
+        tree_root = self.use_tree('ubuntu')
+        pyvassc.configure_host()
+        self.assertTrue(pyvassc.restore_backup('latest'))
+        restored = read_tree(tree_root)
+        expected = read_tree(trees_path + '/ubuntu/before')
+        for path in expected:
+            self.assertEqual(restored[path], expected[path], path)
+
+    def test_restore_mode(self):
+        tree_root = self.use_tree('centos')
+        login = tree_root + '/etc/pam.d/login'
+        os.chmod(login, 0o640)
+        run_id = pyvassc.backup_pam([login, tree_root + '/etc/pam.d/missing'])
+        with open(login, "w") as login_file:
+            login_file.write('changed\n')
+        os.chmod(login, 0o600)
+        self.assertTrue(pyvassc.restore_backup(run_id))
+        self.assertEqual(read_tree(tree_root)['etc/pam.d/login'], read_tree(trees_path + '/centos/before')['etc/pam.d/login'])
+        self.assertEqual(stat.S_IMODE(os.stat(login).st_mode), 0o640)
+        self.assertEqual([entry['path'] for entry in pyvassc.list_backups()[-1]['files']], [login])
+
+    def test_runs_are_kept_apart(self):
+        tree_root = self.use_tree('centos')
+        login = tree_root + '/etc/pam.d/login'
+        first = pyvassc.backup_pam([login])
+        with open(login, "a") as login_file:
+            login_file.write('# second\n')
+        second = pyvassc.backup_pam([login])
+        self.assertNotEqual(first, second)
+        self.assertTrue(pyvassc.restore_backup(first))
+        self.assertEqual(read_tree(tree_root)['etc/pam.d/login'], read_tree(trees_path + '/centos/before')['etc/pam.d/login'])
+
+    def test_damaged_backup(self):
+        tree_root = self.use_tree('centos')
+        login = tree_root + '/etc/pam.d/login'
+        run_id = pyvassc.backup_pam([login])
+        for name in os.listdir(pyvassc.backup_dir + '/objects'):
+            with open(pyvassc.backup_dir + '/objects/' + name, "a") as object_file:
+                object_file.write('damage\n')
+        with open(login, "w") as login_file:
+            login_file.write('changed\n')
+        self.assertFalse(pyvassc.restore_backup(run_id))
+        self.assertEqual(read_tree(tree_root)['etc/pam.d/login'], 'changed\n')
+
+    def test_plan_errors_write_no_backup(self): # A service vastool has not configured stops the run before its backup.
+        tree_root = self.use_tree('centos')
+        login = tree_root + '/etc/pam.d/login'
+        with open(login, "r") as login_file:
+            lines = [line for line in login_file if 'pam_vas_smartcard' not in line]
+        with open(login, "w") as login_file:
+            login_file.write(''.join(lines))
+        with self.assertRaises(SystemExit):
+            pyvassc.configure_host()
+        self.assertEqual(pyvassc.list_backups(), [])
+        self.assertEqual(read_tree(tree_root)['etc/pam.d/login'], ''.join(lines))
+
+    def test_unknown_run(self):
+        self.assertFalse(pyvassc.restore_backup('19700101-000000-1'))
+
+class WatchTest(TreeTestCase): # A signal during a correction stops the watcher, a failed correction does not.
+
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        self.saved_functions = (pyvassc.correct_drift, pyvassc.inotify_read, pyvassc.transaction_commit)
+
+    def tearDown(self):
+        pyvassc.correct_drift, pyvassc.inotify_read, pyvassc.transaction_commit = self.saved_functions
+        TreeTestCase.tearDown(self)
+
+    def stop_reading(self, inotify):
+        raise KeyboardInterrupt()
+
+    def test_signal_rolls_back_with_its_exit_status(self):
+        tree_root = self.use_tree('centos')
+        def signalled_commit(transaction):
+            os.kill(os.getpid(), signal.SIGHUP)
+        pyvassc.transaction_commit = signalled_commit
+        with self.assertRaises(SystemExit) as raised:
+            pyvassc.configure_host()
+        self.assertEqual(raised.exception.code, 128 + signal.SIGHUP)
+        self.assertTree(tree_root, 'centos', 'before')
+
+    def test_signal_stops_watch(self):
+        self.use_tree('centos')
+        def signalled(changed):
+            pyvassc.exit_script(128 + signal.SIGTERM)
+        pyvassc.correct_drift = signalled
+        pyvassc.inotify_read = self.stop_reading
+        with self.assertRaises(SystemExit) as raised:
+            pyvassc.watch()
+        self.assertEqual(raised.exception.code, 128 + signal.SIGTERM)
+
+    def test_failed_correction_keeps_watching(self):
+        self.use_tree('centos')
+        calls = []
+        def failed(changed):
+            calls.append(changed)
+            pyvassc.exit_script(1)
+        pyvassc.correct_drift = failed
+        pyvassc.inotify_read = self.stop_reading
+        self.assertEqual(pyvassc.watch(), 0)
+        self.assertEqual(len(calls), 1)
+
+class TransactionTest(TreeTestCase): # A second signal during the rollback does not leave a half restored PAM stack.
+
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        self.saved_functions = (pyvassc.transaction_commit, pyvassc.write_file_atomic)
+
+    def tearDown(self):
+        pyvassc.transaction_commit, pyvassc.write_file_atomic = self.saved_functions
+        TreeTestCase.tearDown(self)
+
+    def test_signal_during_rollback(self):
+        tree_root = self.use_tree('mint')
+        commit, write_file_atomic = self.saved_functions
+        rolling_back = []
+        def signalled_commit(transaction):
+            commit(transaction)
+            rolling_back.append(True)
+            os.kill(os.getpid(), signal.SIGTERM)
+        def signalled_write(local_file, contents):
+            if rolling_back and rolling_back.pop():
+                os.kill(os.getpid(), signal.SIGINT)
+            write_file_atomic(local_file, contents)
+        pyvassc.transaction_commit = signalled_commit
+        pyvassc.write_file_atomic = signalled_write
+        with self.assertRaises(SystemExit) as raised:
+            pyvassc.configure_host()
+        self.assertEqual(raised.exception.code, 128 + signal.SIGTERM)
+        self.assertEqual(rolling_back, [])
+        self.assertTree(tree_root, 'mint', 'before')
+
+    def test_signal_after_failed_change(self): # A signal during the rollback of a failed change is still reported as one.
+        tree_root = self.use_tree('mint')
+        commit, write_file_atomic = self.saved_functions
+        rolling_back = []
+        def failed_commit(transaction):
+            commit(transaction)
+            rolling_back.append(True)
+            raise pyvassc.TransactionInterrupted('failed')
+        def signalled_write(local_file, contents):
+            if rolling_back and rolling_back.pop():
+                os.kill(os.getpid(), signal.SIGHUP)
+            write_file_atomic(local_file, contents)
+        pyvassc.transaction_commit = failed_commit
+        pyvassc.write_file_atomic = signalled_write
+        with self.assertRaises(SystemExit) as raised:
+            pyvassc.configure_host()
+        self.assertEqual(raised.exception.code, 128 + signal.SIGHUP)
+        self.assertTree(tree_root, 'mint', 'before')
+
+class CommandLineTest(unittest.TestCase): # Options alone run the install, and running main() again adds no second console handler.
+
+    def setUp(self):
+        self.saved = (pyvassc.run_command_line, pyvassc.root_path, pyvassc.logger.level)
+        self.commands = []
+        pyvassc.run_command_line = lambda args: self.commands.append((args.command, pyvassc.root_path)) or 0
+
+    def tearDown(self):
+        pyvassc.run_command_line = self.saved[0]
+        pyvassc.set_root(self.saved[1])
+        pyvassc.logger.setLevel(self.saved[2])
+
+    def test_options_without_command(self):
+        self.assertEqual(pyvassc.main(['--root', '/mnt']), 0)
+        self.assertEqual(pyvassc.main(['--log-dir', '/tmp', '-y']), 0)
+        self.assertEqual(self.commands, [('install', '/mnt'), ('install', '/')])
+
+    def test_command_after_options(self):
+        pyvassc.main(['--root', '/mnt', 'audit'])
+        self.assertEqual(self.commands, [('audit', '/mnt')])
+
+    def test_handlers_added_once(self):
+        pyvassc.main(['audit'])
+        handlers = list(pyvassc.logger.handlers)
+        pyvassc.main(['audit'])
+        self.assertEqual(pyvassc.logger.handlers, handlers)
+
+class RunCommandTest(unittest.TestCase): # A cancelled command that ignores SIGTERM is still killed kill_grace seconds later.
+
+    def setUp(self):
+        self.saved = (pyvassc.kill_grace, pyvassc.logger.level)
+        pyvassc.kill_grace = 0.5
+        pyvassc.logger.setLevel(logging.CRITICAL)
+        self.work_dir = tempfile.mkdtemp(prefix='pyvassc-test-')
+
+    def tearDown(self):
+        pyvassc.kill_grace, level = self.saved
+        pyvassc.logger.setLevel(level)
+        shutil.rmtree(self.work_dir)
+
+    def process_state(self, pid): # State letter from /proc, None once the process is gone.
+        try:
+            with open('/proc/%d/stat' % pid, "r") as stat_file:
+                return stat_file.read().rsplit(')', 1)[1].split()[0]
+        except IOError:
+            return None
+
+    def test_cancel_kills_after_grace(self):
+        pid_file = self.work_dir + '/pid'
+        interrupt = threading.Timer(0.5, os.kill, [os.getpid(), signal.SIGINT])
+        interrupt.start()
+        with self.assertRaises(KeyboardInterrupt):
+            pyvassc.run_command(['sh', '-c', 'trap "" TERM; echo $$ > ' + pid_file + '; while :; do sleep 0.05; done'])
+        interrupt.join()
+        with open(pid_file, "r") as pid_handle:
+            pid = int(pid_handle.read())
+        self.assertNotIn(self.process_state(pid), (None, 'Z'))
+        time.sleep(pyvassc.kill_grace + 0.5)
+        self.assertIn(self.process_state(pid), (None, 'Z'))
+
+class InstallTest(unittest.TestCase): # Declining the debug install is a choice, a failed install fails the run.
+
+    stubbed = ['ask_continue', 'ask_yes_no', 'remove', 'check_os', 'configure_host', 'installqas']
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='pyvassc-test-')
+        self.saved = dict((name, getattr(pyvassc, name)) for name in self.stubbed + ['facts_cache_path', 'ledger_path', 'debug_flag'])
+        self.saved_level = pyvassc.logger.level
+        self.installs = []
+        pyvassc.facts_cache_path = self.work_dir + '/facts.json'
+        pyvassc.ledger_path = self.work_dir + '/ledger.json'
+        pyvassc.ask_continue = lambda: None
+        pyvassc.remove = lambda: None
+        pyvassc.check_os = lambda: None
+        pyvassc.configure_host = lambda: True
+        pyvassc.logger.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(pyvassc, name, value)
+        pyvassc.logger.setLevel(self.saved_level)
+        pyvassc.set_root('/')
+        shutil.rmtree(self.work_dir)
+
+    def run_install(self, answer, installed):
+        pyvassc.ask_yes_no = lambda question: answer
+        pyvassc.installqas = lambda: self.installs.append(True) or installed
+        saved_stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            return pyvassc.main(['-d', '--log-dir', self.work_dir, 'install'])
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved_stdout
+
+    def test_declined(self):
+        self.assertEqual(self.run_install(False, True), 0)
+        self.assertEqual(self.installs, [])
+        self.assertEqual(pyvassc.read_ledger()['roots'], {})
+
+    def test_failed(self):
+        self.assertEqual(self.run_install(True, False), 1)
+        self.assertEqual(self.installs, [True])
+
+    def test_installed(self):
+        self.assertEqual(self.run_install(True, True), 0)
+        self.assertEqual(self.installs, [True])
+
+class FactsCacheTest(unittest.TestCase): # audit and plan read the host but leave no facts cache behind, configuration runs keep it.
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='pyvassc-test-')
+        self.saved = (pyvassc.facts_cache_path, pyvassc.audit, pyvassc.build_plan, pyvassc.facts_cache_writable, pyvassc.logger.level)
+        pyvassc.facts_cache_path = self.work_dir + '/facts.json'
+        pyvassc.audit = lambda: {'compliant': True}
+        pyvassc.build_plan = lambda: pyvassc.new_plan()
+        pyvassc.logger.setLevel(logging.CRITICAL)
+        pyvassc.set_root('/')
+
+    def tearDown(self):
+        pyvassc.facts_cache_path, pyvassc.audit, pyvassc.build_plan, pyvassc.facts_cache_writable, level = self.saved
+        pyvassc.logger.setLevel(level)
+        pyvassc.set_root('/')
+        shutil.rmtree(self.work_dir)
+
+    def run_main(self, argv):
+        saved_stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            return pyvassc.main(argv)
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved_stdout
+
+    def test_audit_and_plan_do_not_write(self):
+        self.assertEqual(self.run_main(['audit']), 0)
+        self.assertEqual(self.run_main(['plan']), 0)
+        self.assertFalse(os.path.exists(pyvassc.facts_cache_path))
+
+    def test_configuration_runs_write(self):
+        pyvassc.facts_cache_writable = True
+        pyvassc.get_host_facts()
+        self.assertTrue(os.path.exists(pyvassc.facts_cache_path))
+
+if __name__ == '__main__':
+    unittest.main()